@@ -0,0 +1,138 @@
+"""Compare MQTT traffic of mqtt_protocol 3.1.1 and 5 against a local broker stand-in.
+
+Run from the repository root: python3 benchmarks/bench_mqtt_wire.py [--devices 10] [--heartbeats 60]
+
+The stand-in accepts one client, answers CONNECT/SUBSCRIBE/PUBLISH/PINGREQ just enough to keep
+paho going, and counts the bytes and packets it receives, retained publishes (writes to a real
+broker's retained store) and the CPU time it spends reading and dispatching packets. Heartbeats
+are synthetic and go through EcoflowDecoder.handle_heartbeat over a real socket.
+"""
+import argparse
+import random
+import socket
+import sys
+import threading
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from decoder import HEARTBEAT_CODEC, EcoflowDecoder
+from ecoflow_pb2 import InverterHeartbeat
+
+
+class BrokerStandIn:
+    def __init__(self, topic_alias_maximum):
+        self.topic_alias_maximum = topic_alias_maximum
+        self.server = socket.create_server(("127.0.0.1", 0))
+        self.port = self.server.getsockname()[1]
+        self.stats = {"bytes": 0, "packets": 0, "publishes": 0, "retained": 0, "cpu": 0.0}
+        self.mqtt5 = False
+        threading.Thread(target=self._serve, daemon=True).start()
+
+    def _read(self, conn, n):
+        data = b""
+        while len(data) < n:
+            chunk = conn.recv(n - len(data))
+            if not chunk:
+                raise ConnectionError
+            data += chunk
+        return data
+
+    def _serve(self):
+        conn, _ = self.server.accept()
+        try:
+            while True:
+                first = self._read(conn, 1)[0]
+                length, shift, header = 0, 0, 1
+                while True:
+                    byte = self._read(conn, 1)[0]
+                    header += 1
+                    length |= (byte & 0x7F) << shift
+                    if byte < 0x80:
+                        break
+                    shift += 7
+                body = self._read(conn, length)
+                started = time.thread_time()
+                self._handle(conn, first, body)
+                self.stats["cpu"] += time.thread_time() - started
+                self.stats["bytes"] += header + length
+                self.stats["packets"] += 1
+        except (ConnectionError, OSError):
+            pass
+
+    def _handle(self, conn, first, body):
+        kind = first >> 4
+        if kind == 1:  # CONNECT: protocol level is the byte after the protocol name
+            self.mqtt5 = body[6] == 5
+            if self.mqtt5:
+                conn.sendall(bytes((0x20, 6, 0, 0, 3, 0x22)) + self.topic_alias_maximum.to_bytes(2, "big"))
+            else:
+                conn.sendall(b"\x20\x02\x00\x00")
+        elif kind == 3:  # PUBLISH
+            self.stats["publishes"] += 1
+            self.stats["retained"] += first & 1
+            qos = (first >> 1) & 3
+            if qos:
+                topic_len = int.from_bytes(body[:2], "big")
+                mid = body[2 + topic_len:4 + topic_len]
+                conn.sendall(b"\x40\x02" + mid)
+        elif kind == 8:  # SUBSCRIBE
+            mid = body[:2]
+            conn.sendall((b"\x90\x04" + mid + b"\x00\x00") if self.mqtt5 else (b"\x90\x03" + mid + b"\x00"))
+        elif kind == 12:  # PINGREQ
+            conn.sendall(b"\xd0\x00")
+
+
+def run(protocol, devices, heartbeats, alias_maximum, seed=1):
+    broker = BrokerStandIn(alias_maximum)
+    decoder = EcoflowDecoder({"mqtt_host": "127.0.0.1", "mqtt_port": broker.port, "mqtt_protocol": protocol,
+                              "device_file": "", "energy_interval": 0})
+    decoder.mqtt_port = broker.port
+    connected = threading.Event()
+    on_connect = decoder.client.on_connect
+    decoder.client.on_connect = lambda *args: (on_connect(*args), connected.set())
+    decoder.client.connect("127.0.0.1", broker.port, 60)
+    decoder.client.loop_start()
+    if not connected.wait(5):
+        raise RuntimeError("stand-in broker did not accept the connection")
+    rng = random.Random(seed)
+    serials = [f"HW51ZKH4SF5P{i:04d}" for i in range(devices)]
+    for tick in range(heartbeats):
+        for device_sn in serials:
+            heartbeat = InverterHeartbeat(pv1_input_volt=315, pv1_input_watts=600 + rng.randint(-40, 40),
+                                          pv2_input_watts=570 + rng.randint(-40, 40), bat_input_watts=-600,
+                                          bat_soc=64 + tick // 60, inv_output_watts=6000 + rng.randint(-20, 20),
+                                          inv_temp=310, permanent_watts=6000, lower_limit=10, upper_limit=100,
+                                          inv_brightness=1023, rated_power=8000)
+            decoder.handle_heartbeat(device_sn, HEARTBEAT_CODEC.raw(heartbeat))
+    # Let paho drain its queue, then stop before comparing
+    deadline = time.time() + 10
+    while getattr(decoder.client, "_out_packet", None) and time.time() < deadline:
+        time.sleep(0.05)
+    time.sleep(0.2)
+    decoder.client.disconnect()
+    decoder.client.loop_stop()
+    return broker.stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--devices", type=int, default=10)
+    parser.add_argument("--heartbeats", type=int, default=60)
+    parser.add_argument("--topic-alias-maximum", type=int, default=1024,
+                        help="TopicAliasMaximum the stand-in grants (mosquitto defaults to 10)")
+    args = parser.parse_args()
+    results = {protocol: run(protocol, args.devices, args.heartbeats, args.topic_alias_maximum)
+               for protocol in ("3.1.1", "5")}
+    for protocol, stats in results.items():
+        print(f"MQTT {protocol:>5}: {stats['bytes']:>9} bytes, {stats['packets']:>6} packets, "
+              f"{stats['retained']:>6}/{stats['publishes']} publishes retained, "
+              f"stand-in CPU {1000 * stats['cpu']:.1f} ms")
+    base, v5 = results["3.1.1"], results["5"]
+    print(f"MQTT 5 sends {v5['bytes'] / base['bytes']:.2f}x the bytes and "
+          f"{v5['retained'] / max(base['retained'], 1):.2f}x the retained writes of 3.1.1")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""Compare per-device state memory: DeviceRegistry records vs the previous dict-of-heartbeats layout.
+
+Run from the repository root: python3 benchmarks/bench_registry_memory.py [--devices 1000]
+
+Each layout is built in a fresh interpreter. Resident set growth is reported alongside
+tracemalloc, since protobuf messages live in C memory that tracemalloc does not see.
+"""
+import argparse
+import gc
+import subprocess
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from decoder import DeviceRegistry, HEARTBEAT_CODEC
+from ecoflow_pb2 import InverterHeartbeat
+
+
+def heartbeat(i):
+    # Every field set, as in a real PowerStream heartbeat
+    message = InverterHeartbeat()
+    for n, field in enumerate(InverterHeartbeat.DESCRIPTOR.fields):
+        setattr(message, field.name, 100 + (i + n) % 900)
+    return message
+
+
+def build_dicts(serials, frames):
+    # The layout before DeviceRegistry records: parsed messages plus parallel per-device dicts
+    heartbeats, last_seen, device_online = {}, {}, {}
+    for device_sn in serials:
+        heartbeats[device_sn] = InverterHeartbeat.FromString(frames[device_sn])
+        last_seen[device_sn] = time.time()
+        device_online[device_sn] = True
+    return heartbeats, last_seen, device_online
+
+
+def build_registry(serials, frames):
+    registry = DeviceRegistry()
+    for device_sn in serials:
+        registry.update(device_sn, HEARTBEAT_CODEC.raw(InverterHeartbeat.FromString(frames[device_sn])), time.time())
+        registry.record(device_sn).online = True
+    return registry
+
+
+def rss():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * 4096
+
+
+def measure(layout, devices):
+    serials = [f"HW51ZKH4SF5P{i:04d}" for i in range(devices)]
+    frames = {device_sn: heartbeat(i).SerializeToString() for i, device_sn in enumerate(serials)}
+    build = build_dicts if layout == "dicts" else build_registry
+    build(serials[:1], frames)  # warm up imports and caches outside the measurement
+    gc.collect()
+    tracemalloc.start()
+    before = rss()
+    state = build(serials, frames)
+    gc.collect()
+    traced = tracemalloc.get_traced_memory()[0]
+    print(rss() - before, traced)
+    return state
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--devices", type=int, default=1000)
+    parser.add_argument("--layout", choices=("dicts", "registry"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.layout:
+        measure(args.layout, args.devices)
+        return
+
+    results = {}
+    for layout in ("dicts", "registry"):
+        out = subprocess.run([sys.executable, __file__, "--layout", layout, "--devices", str(args.devices)],
+                             check=True, capture_output=True, text=True).stdout
+        results[layout] = [int(value) for value in out.split()]
+    for layout, (resident, traced) in results.items():
+        print(f"{layout:>8}: {resident / args.devices:7.0f} B/device resident, {traced / args.devices:7.0f} B/device traced")
+    print(f"registry uses {results['registry'][0] / max(results['dicts'][0], 1):.2f}x the resident memory "
+          f"for {args.devices} devices")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,200 @@
+"""Capture replay and synthetic traffic benchmarks for EcoflowDecoder.
+
+Run from the repository root:
+
+    python3 benchmarks/replay.py synth /tmp/ps100.cap --devices 100 --duration 300
+    python3 benchmarks/replay.py replay /data/upstream.cap --speed 10
+    python3 benchmarks/replay.py suite
+
+Captures use the format written by decoder.CaptureWriter (capture_file option).
+Frames are fed through EcoflowDecoder.on_message and drained through the decode
+and publish stages inline, against a fake MQTT client that counts publishes.
+"""
+import argparse
+import mmap
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from decoder import CAPTURE_MAGIC, CAPTURE_OFFSET, CAPTURE_RECORD, CaptureWriter, EcoflowDecoder
+from ecoflow_pb2 import HeaderMessage, InverterHeartbeat
+
+
+class CaptureReader:
+    # Memory-mapped capture; records are located through the .idx file when it is present
+
+    def __init__(self, path):
+        self.path = Path(path)
+        with open(self.path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._map[:len(CAPTURE_MAGIC)] != CAPTURE_MAGIC:
+            raise ValueError(f"{self.path} is not an EcoFlow capture")
+        index_path = Path(f"{self.path}.idx")
+        if index_path.exists():
+            index = index_path.read_bytes()
+            self._offsets = [offset for (offset,) in CAPTURE_OFFSET.iter_unpack(index)]
+        else:
+            self._offsets = self._scan()
+
+    def _scan(self):
+        offsets, offset = [], len(CAPTURE_MAGIC)
+        while offset + CAPTURE_RECORD.size <= len(self._map):
+            _, topic_len, payload_len = CAPTURE_RECORD.unpack_from(self._map, offset)
+            offsets.append(offset)
+            offset += CAPTURE_RECORD.size + topic_len + payload_len
+        return offsets
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def __getitem__(self, i):
+        offset = self._offsets[i]
+        timestamp, topic_len, payload_len = CAPTURE_RECORD.unpack_from(self._map, offset)
+        start = offset + CAPTURE_RECORD.size
+        topic = self._map[start:start + topic_len].decode()
+        return timestamp, topic, self._map[start + topic_len:start + topic_len + payload_len]
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+
+class FakeClient:
+    # Stands in for paho: counts publishes and payload bytes instead of sending them
+
+    def __init__(self):
+        self.publishes, self.bytes = 0, 0
+
+    def publish(self, topic, payload=None, qos=0, retain=False, properties=None):
+        self.publishes += 1
+        self.bytes += len(topic) + (len(payload) if payload else 0)
+
+
+class Message:
+    __slots__ = ("topic", "payload")
+
+    def __init__(self, topic, payload):
+        self.topic, self.payload = topic, payload
+
+
+def synthesize(path, devices, duration=300.0, period=5.0, seed=1):
+    # Heartbeats from `devices` PowerStreams every `period` seconds, staggered across the period
+    rng = random.Random(seed)
+    template = InverterHeartbeat(pv1_input_volt=315, pv1_op_volt=3100, pv1_input_cur=20, pv1_input_watts=600,
+                                 pv1_temp=250, pv2_input_volt=320, pv2_op_volt=3150, pv2_input_cur=18,
+                                 pv2_input_watts=570, pv2_temp=245, bat_input_volt=500, bat_op_volt=510,
+                                 bat_input_cur=-12, bat_input_watts=-600, bat_temp=220, bat_soc=64,
+                                 llc_input_volt=3800, llc_op_volt=3800, llc_temp=300, inv_input_volt=3800,
+                                 inv_op_volt=2300, inv_output_cur=2600, inv_output_watts=6000, inv_temp=310,
+                                 inv_freq=500, inv_dc_cur=100, bp_type=1, install_country=17477,
+                                 permanent_watts=6000, dynamic_watts=6000, lower_limit=10, upper_limit=100,
+                                 inv_on_off=1, inv_brightness=1023, heartbeat_frequency=1, rated_power=8000,
+                                 battery_charge_remain=120, battery_discharge_remain=300)
+    serials = [f"HW51ZKH4SF5P{i:04d}" for i in range(devices)]
+    start = time.time()
+    writer = CaptureWriter(path)
+    try:
+        for tick in range(int(duration / period)):
+            for i, device_sn in enumerate(serials):
+                heartbeat = InverterHeartbeat()
+                heartbeat.CopyFrom(template)
+                heartbeat.pv1_input_watts = max(0, template.pv1_input_watts + rng.randint(-40, 40))
+                heartbeat.pv2_input_watts = max(0, template.pv2_input_watts + rng.randint(-40, 40))
+                heartbeat.inv_output_watts = template.inv_output_watts + rng.randint(-20, 20)
+                heartbeat.bat_soc = min(100, template.bat_soc + tick // 60)
+                message = HeaderMessage()
+                header = message.header.add()
+                header.pdata = heartbeat.SerializeToString()
+                header.src, header.dest, header.cmd_func, header.cmd_id = 1, 32, 20, 1
+                header.data_len, header.device_sn = len(header.pdata), device_sn
+                writer.write(f"/sys/75/{device_sn}/thing/protobuf/upstream", message.SerializeToString(),
+                             timestamp=start + tick * period + i * period / devices)
+    finally:
+        writer.close()
+
+
+def replay(path, speed=0.0, allocations=False):
+    # Feed a capture through on_message; speed 0 replays as fast as possible, N replays at N x real time
+    reader = CaptureReader(path)
+    # Explicit options so results do not depend on the host's /data/options.json or device file
+    decoder = EcoflowDecoder({"device_file": ""})
+    decoder.client = client = FakeClient()
+    latencies = []
+    if allocations:
+        tracemalloc.start()
+    first, started = None, time.perf_counter()
+    for timestamp, topic, payload in reader:
+        if speed:
+            first = timestamp if first is None else first
+            delay = (timestamp - first) / speed - (time.perf_counter() - started)
+            if delay > 0:
+                time.sleep(delay)
+        t0 = time.perf_counter()
+        decoder.on_message(client, None, Message(topic, bytes(payload)))
+        while len(decoder._decode_queue):
+            decoder.decode_step(*decoder._decode_queue.get())
+        while len(decoder._publish_queue):
+            decoder.publish_step(*decoder._publish_queue.get())
+        latencies.append(time.perf_counter() - t0)
+    elapsed = time.perf_counter() - started
+    peak = tracemalloc.get_traced_memory()[1] if allocations else None
+    if allocations:
+        tracemalloc.stop()
+    latencies.sort()
+    count = len(latencies) or 1
+    return {
+        "messages": len(latencies),
+        "devices": len(decoder.devices),
+        "throughput": len(latencies) / elapsed if elapsed else 0.0,
+        "publishes_per_message": client.publishes / count,
+        "bytes_per_message": client.bytes / count,
+        "p50_ms": 1000 * latencies[len(latencies) // 2] if latencies else 0.0,
+        "p99_ms": 1000 * latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] if latencies else 0.0,
+        "peak_alloc_kib": peak / 1024 if peak is not None else None
+    }
+
+
+def report(name, result):
+    line = (f"{name:>10}: {result['messages']} msgs from {result['devices']} devices, "
+            f"{result['throughput']:.0f} msg/s, {result['publishes_per_message']:.1f} publishes/msg "
+            f"({result['bytes_per_message']:.0f} B), p50 {result['p50_ms']:.3f} ms, p99 {result['p99_ms']:.3f} ms")
+    if result["peak_alloc_kib"] is not None:
+        line += f", peak alloc {result['peak_alloc_kib']:.0f} KiB"
+    print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+    synth = commands.add_parser("synth", help="generate a synthetic capture")
+    synth.add_argument("path")
+    synth.add_argument("--devices", type=int, default=10)
+    synth.add_argument("--duration", type=float, default=300.0)
+    synth.add_argument("--period", type=float, default=5.0)
+    play = commands.add_parser("replay", help="replay a capture")
+    play.add_argument("path")
+    play.add_argument("--speed", type=float, default=0.0, help="N x real time; 0 = as fast as possible")
+    play.add_argument("--allocations", action="store_true", help="trace allocations (slower)")
+    suite = commands.add_parser("suite", help="synthetic 1/10/100/1000 device benchmark")
+    suite.add_argument("--duration", type=float, default=60.0)
+    suite.add_argument("--allocations", action="store_true")
+    args = parser.parse_args()
+
+    if args.command == "synth":
+        synthesize(args.path, args.devices, args.duration, args.period)
+    elif args.command == "replay":
+        report(Path(args.path).name, replay(args.path, args.speed, args.allocations))
+    else:
+        with tempfile.TemporaryDirectory() as tmp:
+            for devices in (1, 10, 100, 1000):
+                path = Path(tmp) / f"ps{devices}.cap"
+                synthesize(path, devices, args.duration)
+                report(f"{devices} PS", replay(path, allocations=args.allocations))
+
+
+if __name__ == "__main__":
+    main()
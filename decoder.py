@@ -1,112 +1,2181 @@
+import asyncio
+import base64
+import bisect
+import collections
+import heapq
+import inspect
+import itertools
 import json
-import re
+import operator
+import os
+import signal
+import struct
+import sys
 import time
 import threading
+import zlib
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from pathlib import Path
+from urllib.parse import parse_qs, urlsplit
 import logging
 import paho.mqtt.client as mqtt
-from ecoflow_pb2 import HeaderMessage, InverterHeartbeat, setMessage, setHeader, setValue, SendMsgHart, SupplyPriorityPack, BatLowerPack, BatUpperPack, BrightnessPack
-from google.protobuf.message import DecodeError
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
+from ecoflow_pb2 import HeaderMessage, InverterHeartbeat, setHeader, setValue, SendMsgHart, SupplyPriorityPack, BatLowerPack, BatUpperPack, BrightnessPack
+from google.protobuf.descriptor import FieldDescriptor
+from google.protobuf import text_format
+from google.protobuf.message import DecodeError, Message
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
 
-class EcoflowDecoder:
+# Bump whenever the shape of the discovery payloads changes so cached configs are rebuilt
+DISCOVERY_SCHEMA_VERSION = 1
+
+# Converts raw brightness (0–1023) to a percentage for HA
+def _brightness_percent(raw):
+    return int((raw / 1023.0) * 100)
+
+# Field spec table for InverterHeartbeat: (field, name, scale, unit, hidden)
+# scale divides the raw value (1 = published as-is) or is a converter function;
+# hidden entities are registered disabled by default in HA
+HEARTBEAT_FIELDS = (
+    ("inv_error_code", "Inverter Error Code", 1, None, True),
+    ("inv_warning_code", "Inverter Warning Code", 1, None, True),
+    ("pv1_error_code", "PV1 Error Code", 1, None, True),
+    ("pv1_warning_code", "PV1 Warning Code", 1, None, True),
+    ("pv2_error_code", "PV2 Error Code", 1, None, True),
+    ("pv2_warning_code", "PV2 Warning Code", 1, None, True),
+    ("bat_error_code", "Battery Error Code", 1, None, True),
+    ("bat_warning_code", "Battery Warning Code", 1, None, True),
+    ("llc_error_code", "LLC Error Code", 1, None, True),
+    ("llc_warning_code", "LLC Warning Code", 1, None, True),
+    ("wireless_error_code", "Wireless Error Code", 1, None, True),
+    ("wireless_warning_code", "Wireless Warning Code", 1, None, True),
+    ("pv1_status", "PV1 Status", 1, None, True),
+    ("pv2_status", "PV2 Status", 1, None, True),
+    ("bat_status", "Battery Status", 1, None, True),
+    ("llc_status", "LLC Status", 1, None, True),
+    ("inv_status", "Inverter Status", 1, None, True),
+    ("pv1_input_volt", "PV1 Input Voltage", 10, "V", False),
+    ("pv1_op_volt", "PV1 Operating Voltage", 100, "V", False),
+    ("pv1_input_cur", "PV1 Input Current", 10, "A", False),
+    ("pv1_input_watts", "PV1 Input Power", 10, "W", False),
+    ("pv1_temp", "PV1 Temperature", 10, "°C", False),
+    ("pv2_input_volt", "PV2 Input Voltage", 10, "V", False),
+    ("pv2_op_volt", "PV2 Operating Voltage", 100, "V", False),
+    ("pv2_input_cur", "PV2 Input Current", 10, "A", False),
+    ("pv2_input_watts", "PV2 Input Power", 10, "W", False),
+    ("pv2_temp", "PV2 Temperature", 10, "°C", False),
+    ("bat_input_volt", "Battery Input Voltage", 10, "V", False),
+    ("bat_op_volt", "Battery Operating Voltage", 10, "V", False),
+    ("bat_input_cur", "Battery Input Current", 10, "A", False),
+    ("bat_input_watts", "Battery Input Power", 10, "W", False),
+    ("bat_temp", "Battery Temperature", 10, "°C", False),
+    ("bat_soc", "Battery State of Charge", 1, "%", False),
+    ("llc_input_volt", "LLC Input Voltage", 10, "V", False),
+    ("llc_op_volt", "LLC Operating Voltage", 100, "V", False),
+    ("llc_temp", "LLC Temperature", 10, "°C", False),
+    ("inv_input_volt", "Inverter Input Voltage", 100, "V", False),
+    ("inv_op_volt", "Inverter Operating Voltage", 10, "V", False),
+    ("inv_output_cur", "Inverter Output Current", 1000, "A", False),
+    ("inv_output_watts", "Inverter Output Power", 10, "W", False),
+    ("inv_temp", "Inverter Temperature", 10, "°C", False),
+    ("inv_freq", "Inverter Frequency", 10, "Hz", False),
+    ("inv_dc_cur", "Inverter DC Current", 1000, "A", False),
+    ("bp_type", "Battery Pack Type", 1, None, False),
+    ("inv_relay_status", "Inverter Relay Status", 1, None, True),
+    ("pv1_relay_status", "PV1 Relay Status", 1, None, True),
+    ("pv2_relay_status", "PV2 Relay Status", 1, None, True),
+    ("install_country", "Installation Country", 1, None, False),
+    ("install_town", "Installation Town", 1, None, False),
+    ("permanent_watts", "Permanent Power", 10, "W", False),
+    ("dynamic_watts", "Dynamic Power", 10, "W", False),
+    ("supply_priority", "Supply Priority", 1, None, False),
+    ("lower_limit", "Discharge Limit", 1, "%", False),
+    ("upper_limit", "Charge Limit", 1, "%", False),
+    ("inv_on_off", "Inverter On/Off", 1, None, False),
+    ("inv_brightness", "Inverter Brightness", _brightness_percent, "%", False),
+    ("heartbeat_frequency", "Heartbeat Frequency", 1, "s", False),
+    ("rated_power", "Rated Power", 10, "W", False),
+    ("battery_charge_remain", "Battery Charge Remaining", 1, "min", False),
+    ("battery_discharge_remain", "Battery Discharge Remaining", 1, "min", False),
+)
+
+# Deadband option for each unit; state changes within the deadband are not republished
+DEADBAND_OPTIONS = {
+    "W": "deadband_power",
+    "V": "deadband_voltage",
+    "A": "deadband_current",
+    "°C": "deadband_temperature",
+    "Hz": "deadband_frequency"
+}
+
+# Control entities: state key -> (component, object id suffix)
+CONTROL_STATES = {
+    "power_limit": ("number", "power_limit"),
+    "supply_mode": ("select", "supply_mode"),
+    "lower_limit": ("number", "battery_lower_limit"),
+    "upper_limit": ("number", "battery_upper_limit"),
+    "inv_brightness": ("number", "inverter_brightness")
+}
+
+# Control state key -> (heartbeat field, raw field value -> control state value as heartbeats publish
+# it). Commands are tracked with the raw value they set, which is compared with the heartbeat field
+# as is: converted values such as brightness percentages do not survive the round trip
+CONTROL_REPORTED = {
+    "power_limit": ("permanent_watts", lambda raw: int(raw / 10)),
+    "supply_mode": ("supply_priority", lambda raw: "Prioritize power supply" if raw == 0 else "Prioritize power storage"),
+    "lower_limit": ("lower_limit", lambda raw: raw),
+    "upper_limit": ("upper_limit", lambda raw: raw),
+    "inv_brightness": ("inv_brightness", _brightness_percent)
+}
+
+# Control /set topics: (component, object id suffix) -> EcoflowDecoder handler
+CONTROL_HANDLERS = {
+    ("number", "power_limit"): "on_slider_change_raw",
+    ("select", "supply_mode"): "on_supply_mode_change",
+    ("number", "battery_lower_limit"): "on_lower_limit_change",
+    ("number", "battery_upper_limit"): "on_upper_limit_change",
+    ("number", "inverter_brightness"): "on_brightness_change"
+}
+
+STATE_MODES = ("topics", "json")
+
+RUNTIMES = ("threads", "asyncio")
+
+# Clustered mode: members missing this many announcement intervals are dropped; after a (re)connect
+# a member waits CLUSTER_SETTLE seconds for the retained member list before acting as an owner,
+# and a device it takes over gets CLUSTER_SEED_WAIT seconds to read back the previous owner's
+# retained energy states before its own are published
+CLUSTER_EXPIRY = 3
+CLUSTER_SETTLE = 2.0
+CLUSTER_SEED_WAIT = 5.0
+TOPIC_UNSAFE = str.maketrans("/+#", "___")
+
+# (qos, retain) per publish class under each mqtt_protocol; publish_policy entries override them.
+# MQTT 5 defaults keep high-rate telemetry out of the broker's retained store: HA gets a full
+# resync from its birth message instead
+PUBLISH_POLICIES = {
+    "3.1.1": {"discovery": (0, True), "availability": (0, True), "telemetry": (0, True), "control": (0, True),
+              "energy": (0, True), "events": (0, False), "command": (0, False), "cluster": (1, True), "forward": (0, False),
+              "trace": (0, False)},
+    "5": {"discovery": (1, True), "availability": (1, True), "telemetry": (0, False), "control": (1, True),
+          "energy": (0, True), "events": (0, False), "command": (0, False), "cluster": (1, True), "forward": (0, False),
+          "trace": (0, False)},
+}
+# MQTT 5: classes whose QoS 0 topics get topic aliases, and classes that carry message_expiry
+ALIASED_CLASSES = frozenset(("telemetry", "control", "energy", "command", "forward"))
+EXPIRING_CLASSES = frozenset(("telemetry", "events"))
+
+# Heartbeat fields that get a sensor entity under each entity_profile (None = every field);
+# "diagnostic" also enables the hidden entities by default
+ENTITY_PROFILES = {
+    "minimal": ("pv1_input_watts", "pv2_input_watts", "bat_input_watts", "bat_soc", "bat_temp",
+                "inv_output_watts", "inv_temp", "permanent_watts", "battery_charge_remain", "battery_discharge_remain"),
+    "standard": tuple(spec[0] for spec in HEARTBEAT_FIELDS if not spec[4]),
+    "full": None,
+    "diagnostic": None
+}
+
+DEVICE_CLASSES = {
+    "V": "voltage",
+    "mV": "voltage",
+    "A": "current",
+    "W": "power",
+    "Wh": "energy",
+    "%": "battery",
+    "C": "temperature",
+    "Hz": "frequency",
+    "s": "duration",
+    "min": "duration"
+}
+
+PACKED_TYPES = {FieldDescriptor.TYPE_INT32: "i", FieldDescriptor.TYPE_UINT32: "I"}
+
+
+class FieldCodec:
+    # Field spec table compiled against a protobuf descriptor into flat, index-aligned tuples
+
+    def __init__(self, message_type, specs, partial=False):
+        descriptor = message_type.DESCRIPTOR
+        spec_keys = [spec[0] for spec in specs]
+        missing = [] if partial else [f.name for f in descriptor.fields if f.name not in spec_keys]
+        unknown = [key for key in spec_keys if key not in descriptor.fields_by_name]
+        if missing or unknown:
+            raise RuntimeError(f"{descriptor.name} field specs out of date with ecoflow_pb2 "
+                               f"(no spec: {missing}, not in proto: {unknown})")
+        self.message_type, self.specs = message_type, tuple(specs)
+        # (field number, key, name, scale, unit, device_class, hidden)
+        self.entries = tuple(
+            (descriptor.fields_by_name[key].number, key, name, scale, unit, DEVICE_CLASSES.get(unit), hidden)
+            for key, name, scale, unit, hidden in specs)
+        self.keys = tuple(spec_keys)
+        self.index = {key: i for i, key in enumerate(self.keys)}
+        self._getter = operator.attrgetter(*self.keys)
+        self._scales = tuple(1 if callable(entry[3]) else entry[3] for entry in self.entries)
+        self._converters = tuple((i, entry[3]) for i, entry in enumerate(self.entries) if callable(entry[3]))
+        # Fixed-width layout for packing raw values into compact records
+        self.layout = struct.Struct("<" + "".join(PACKED_TYPES[descriptor.fields_by_name[key].type] for key in self.keys))
+
+    def raw(self, message):
+        # Unscaled field values, aligned with self.keys
+        return self._getter(message)
+
+    def decode_raw(self, raws):
+        # One pass over the compiled table; result is aligned with self.keys
+        values = [raw if scale == 1 else raw / scale for raw, scale in zip(raws, self._scales)]
+        for i, convert in self._converters:
+            values[i] = convert(values[i])
+        return values
+
+    def select(self, keys):
+        # Codec over a subset of the fields, in table order; fields left out are never read
+        return FieldCodec(self.message_type, [spec for spec in self.specs if spec[0] in keys], partial=True)
+
+
+HEARTBEAT_CODEC = FieldCodec(InverterHeartbeat, HEARTBEAT_FIELDS)
+RAW_PERMANENT_WATTS = HEARTBEAT_CODEC.index["permanent_watts"]
+RAW_SUPPLY_PRIORITY = HEARTBEAT_CODEC.index["supply_priority"]
+# Per-device state record: last seen timestamp followed by every heartbeat field, unscaled
+DEVICE_STATE = struct.Struct("<d" + HEARTBEAT_CODEC.layout.format.lstrip("<"))
+DEVICE_STATE_SEEN = struct.Struct("<d")
+
+# Upstream frame decoders by (serial prefix or product_id, cmd_func, cmd_id) -> (name, pdata message
+# type, field codec, EcoflowDecoder publisher, coalesce). With a codec the publisher gets the raw field
+# values (codec.raw), otherwise the parsed message. Coalesced frames go through the publish queue,
+# where only the latest per device is kept, and are published as publisher(device_sn, decoded); the
+# others are handled in the decode stage, every frame in order, as publisher(device_sn, decoded, header).
+# Serial prefixes are the first SERIAL_PREFIX_LEN characters of device_sn, which upstream topics also
+# carry (/sys/75/<serial>/thing/protobuf/upstream)
+SERIAL_PREFIX_LEN = 4
+# Device event reports are left out until the cmd_func/cmd_id of EventRecordReport and of the
+# EventInfoReportAck reply are confirmed from a capture, since a wrong pair mis-decodes frames. Once
+# they are, the entry is ("EventRecordReport", EventRecordReport, None, "handle_event_report", False),
+# with the reply sent from handle_event_report and an Events entity added to discovery
+FRAME_DECODERS = {
+    # Every heartbeat field is extracted whatever the entity profile: the device registry and file,
+    # history, energy, site sums and command checks keep the full record; the profile only narrows
+    # what is decoded for and published to HA (EcoflowDecoder.codec)
+    ("HW51", 20, 1): ("InverterHeartbeat", InverterHeartbeat, HEARTBEAT_CODEC, "handle_heartbeat", True),
+}
+
+class CoalescingQueue:
+    # Bounded queue holding at most one pending (seq, ...) item per key; a newer item replaces
+    # the queued one in place (latest wins) so a backlog never replays stale frames
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._items = {}
+        self._cond = threading.Condition()
+        self.stats = {"coalesced": 0, "dropped": 0, "max_depth": 0}
+
+    def __len__(self):
+        return len(self._items)
+
+    def put(self, key, item):
+        with self._cond:
+            queued = self._items.get(key)
+            if queued is not None:
+                self.stats["coalesced"] += 1
+                if queued[0] > item[0]:
+                    return False
+            elif len(self._items) >= self.maxsize:
+                self.stats["dropped"] += 1
+                return False
+            self._items[key] = item
+            self.stats["max_depth"] = max(self.stats["max_depth"], len(self._items))
+            self._cond.notify()
+        return True
+
+    def get(self):
+        # Oldest key first; replacing an item keeps its key's place in line
+        with self._cond:
+            while not self._items:
+                self._cond.wait()
+            key = next(iter(self._items))
+            return key, self._items.pop(key)
+
+class FrameQueue:
+    # Bounded FIFO of raw (key, item) frames for the decode stage. Nothing is coalesced here: the
+    # frame kind is only known after parsing, and inline frames such as command acks must not be replaced
+    # by a later heartbeat. Latest-wins happens in the publish queue instead. When full, the oldest
+    # frame is dropped so a backlog is worked off from fresh frames rather than stale ones
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._items = collections.deque()
+        self._cond = threading.Condition()
+        self.stats = {"dropped": 0, "max_depth": 0}
+
+    def __len__(self):
+        return len(self._items)
+
+    def put(self, key, item):
+        with self._cond:
+            if len(self._items) >= self.maxsize:
+                self._items.popleft()
+                self.stats["dropped"] += 1
+            self._items.append((key, item))
+            self.stats["max_depth"] = max(self.stats["max_depth"], len(self._items))
+            self._cond.notify()
+        return True
+
+    def get(self):
+        with self._cond:
+            while not self._items:
+                self._cond.wait()
+            return self._items.popleft()
+
+# Constant setHeader fields of every control command (cmd_id and device_sn vary per template)
+COMMAND_HEADER = {
+    "src": 32,
+    "dest": 53,
+    "d_src": 1,
+    "d_dest": 1,
+    "check_type": 3,
+    "cmd_func": 20,
+    "need_ack": 1,
+    "version": 19,
+    "payload_ver": 1,
+    "from": "ios"
+}
+
+def _varint(value):
+    # Protobuf base-128 varint; negative int32 values take the 10-byte two's complement form
+    if value < 0:
+        value += 1 << 64
+    out = bytearray()
+    while value > 0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+class CommandEncoder:
+    # setMessage frames for control commands. The constant header fields of each (device_sn, cmd_id)
+    # are serialized once; only pdata (1), data_len (10) and seq (14) are spliced in per command,
+    # in field-number order so the bytes match setMessage.SerializeToString()
+
+    def __init__(self):
+        self._templates, self._seqs = {}, {}
+
+    def encode(self, device_sn, cmd_id, pdata, seq=None):
+        template = self._templates.get((device_sn, cmd_id))
+        if template is None:
+            template = self._templates[(device_sn, cmd_id)] = self._build_template(device_sn, cmd_id)
+        before, middle, after = template
+        if seq is None:
+            seq = self.next_seq(device_sn)
+        header = b"".join((
+            b"\x0a" + _varint(len(pdata)) + pdata if pdata else b"",
+            before,
+            b"\x50" + _varint(len(pdata)) if pdata else b"",
+            middle,
+            b"\x70" + _varint(seq),
+            after))
+        return b"\x0a" + _varint(len(header)) + header
+
+    def next_seq(self, device_sn):
+        # Per-device counter seeded from the clock so sequence numbers keep rising across restarts
+        counter = self._seqs.get(device_sn)
+        if counter is None:
+            counter = self._seqs.setdefault(device_sn, itertools.count(int(time.time()) & 0x7FFFFFFF))
+        return next(counter)
+
+    def _build_template(self, device_sn, cmd_id):
+        fields = dict(COMMAND_HEADER, cmd_id=cmd_id, device_sn=device_sn)
+        numbers = setHeader.DESCRIPTOR.fields_by_name
+
+        def segment(low, high):
+            return setHeader(**{k: v for k, v in fields.items() if low <= numbers[k].number < high}).SerializeToString()
+
+        return segment(2, 10), segment(11, 14), segment(15, 26)
+
+
+# Capture file layout: CAPTURE_MAGIC, then per record CAPTURE_RECORD + topic + payload;
+# "<capture>.idx" holds one CAPTURE_OFFSET per record so readers can mmap and seek
+CAPTURE_MAGIC = b"EFCAP\x00\x01\n"
+CAPTURE_RECORD = struct.Struct("<dHI")  # wall-clock time, topic length, payload length
+CAPTURE_OFFSET = struct.Struct("<Q")
+
+class CaptureWriter:
+    # Append-only capture of raw upstream frames as seen by on_message
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self._data = open(self.path, "ab")
+        self._index = open(f"{self.path}.idx", "ab")
+        if self._data.tell() == 0:
+            self._data.write(CAPTURE_MAGIC)
+        self._offset = self._data.tell()
+        self.records = 0
+
+    def write(self, topic, payload, timestamp=None):
+        topic_bytes = topic.encode()
+        self._index.write(CAPTURE_OFFSET.pack(self._offset))
+        self._data.write(CAPTURE_RECORD.pack(time.time() if timestamp is None else timestamp, len(topic_bytes), len(payload)))
+        self._data.write(topic_bytes)
+        self._data.write(payload)
+        self._offset += CAPTURE_RECORD.size + len(topic_bytes) + len(payload)
+        self.records += 1
+
+    def flush(self):
+        # Data before index, so every indexed offset points at a complete record
+        self._data.flush()
+        self._index.flush()
+
+    def close(self):
+        self.flush()
+        self._data.close()
+        self._index.close()
+
+
+# Trace categories (heartbeat_logging: frames and heartbeats, control_logging: controls) and whether
+# their lines are sampled per device; control lines are rare and only rate limited
+TRACE_CATEGORIES = {"frames": True, "heartbeats": True, "controls": False}
+TRACE_TOPIC = "ecoflow_decoder/trace"
+
+
+class Tracer:
+    # Diagnostic log lines. A line is only formatted if its category is on, the device's sample
+    # (every Nth line, N = 1 / its sampling rate) picks it and the category's token bucket has a
+    # token left. Arguments go to logging's %-formatting and protobuf messages are rendered on one
+    # line at that point, so a dropped line costs a few dict lookups. Counters are not locked: a
+    # race can only let an extra line through. Recent raw frames are kept in a ring for dumps
+
+    def __init__(self, categories, sample_rate, device_rates, rate_limit, burst, buffer_size):
+        self.categories = frozenset(categories)
+        self.sample_rate, self.device_rates = sample_rate, device_rates
+        self.rate_limit, self.burst = rate_limit, max(1.0, burst)
+        self._periods, self._counts = {}, {}
+        self._buckets = {category: [self.burst, time.monotonic()] for category in TRACE_CATEGORIES}
+        self.frames = collections.deque(maxlen=buffer_size) if buffer_size > 0 else None
+        self.stats = {category: {"emitted": 0, "sampled": 0, "limited": 0} for category in TRACE_CATEGORIES}
+
+    def _period(self, device_sn):
+        # Rates are set per serial or short name (ps + last 4 characters); 0 silences the device
+        period = self._periods.get(device_sn)
+        if period is None:
+            rate = self.device_rates.get(device_sn, self.device_rates.get(f"ps{device_sn[-4:].lower()}", self.sample_rate))
+            period = self._periods[device_sn] = max(1, round(1 / rate)) if rate > 0 else 0
+        return period
+
+    def trace(self, category, device_sn, message, *args):
+        if category not in self.categories:
+            return
+        stats = self.stats[category]
+        if TRACE_CATEGORIES[category]:
+            period, key = self._period(device_sn), (category, device_sn)
+            count = self._counts.get(key, 0)
+            self._counts[key] = count + 1
+            if not period or count % period:
+                stats["sampled"] += 1
+                return
+        if self.rate_limit > 0:
+            bucket, now = self._buckets[category], time.monotonic()
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate_limit)
+            bucket[1] = now
+            if bucket[0] < 1:
+                stats["limited"] += 1
+                return
+            bucket[0] -= 1
+        stats["emitted"] += 1
+        logging.info(message, *(text_format.MessageToString(arg, as_one_line=True) if isinstance(arg, Message) else arg
+                                for arg in args))
+
+    def record(self, topic, payload):
+        if self.frames is not None:
+            self.frames.append((time.time(), topic, payload))
+
+    def recent(self, device_sn=None, count=None):
+        # (time, topic, payload) of the last `count` buffered frames, optionally of one device only
+        frames = list(self.frames or ())
+        if device_sn is not None:
+            frames = [frame for frame in frames if device_sn in frame[1].split("/")]
+        return frames[-count:] if count else frames
+
+
+class DeviceStore:
+    # Known devices as JSON: serial, last-seen time and last heartbeat (serialized InverterHeartbeat,
+    # base64) in registry order, so short names come back the same. Written to a temporary file and
+    # renamed into place, so a crash mid-write leaves the previous file intact
+
+    def __init__(self, path, expiry):
+        self.path, self.expiry = Path(path), expiry
+
+    def _expired(self, last_seen, now):
+        return self.expiry > 0 and now - last_seen > self.expiry
+
+    def load(self):
+        # [(serial, raw heartbeat values, last seen, entry)], skipping expired and unreadable entries;
+        # entry is the stored dict, for the extra fields given to save()
+        if not self.path.exists():
+            return []
+        try:
+            devices = json.loads(self.path.read_text())["devices"]
+        except (OSError, ValueError, KeyError) as e:
+            logging.warning(f"Ignoring unreadable device state {self.path}: {e}")
+            return []
+        loaded, now = [], time.time()
+        for entry in devices:
+            try:
+                if self._expired(entry["last_seen"], now):
+                    continue
+                heartbeat = InverterHeartbeat.FromString(base64.b64decode(entry["heartbeat"]))
+                loaded.append((entry["device_sn"], HEARTBEAT_CODEC.raw(heartbeat), entry["last_seen"], entry))
+            except (KeyError, TypeError, ValueError, DecodeError) as e:
+                logging.warning(f"Skipping unreadable device state entry: {e}")
+        return loaded
+
+    def save(self, records, extras=None):
+        # extras: serial -> extra fields stored with that device
+        now, devices, extras = time.time(), [], extras or {}
+        for record in records:
+            raw = record.raw()
+            if raw is None or self._expired(record.last_seen, now):
+                continue
+            heartbeat = InverterHeartbeat(**dict(zip(HEARTBEAT_CODEC.keys, raw))).SerializeToString()
+            devices.append({"device_sn": record.device_sn, "last_seen": record.last_seen,
+                            "heartbeat": base64.b64encode(heartbeat).decode(), **extras.get(record.device_sn, {})})
+        tmp = self.path.with_name(f"{self.path.name}.tmp")
+        with open(tmp, "w") as f:
+            json.dump({"version": 1, "devices": devices}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+        return len(devices)
+
+
+class Histogram:
+    # Prometheus-style histogram; observe() takes no lock, so concurrent updates may rarely drop a count
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def render(self, name, labels=""):
+        lines, cumulative = [], 0
+        for bound, count in zip(self.buckets + ("+Inf",), self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels}le="{bound}"}} {cumulative}')
+        label_set = f"{{{labels.rstrip(',')}}}" if labels else ""
+        lines.append(f"{name}_sum{label_set} {self.sum}")
+        lines.append(f"{name}_count{label_set} {cumulative}")
+        return lines
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    # Serves EcoflowDecoder.render_metrics() on /metrics and history queries on /history
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        if url.path == "/metrics":
+            return self._send(200, "text/plain; version=0.0.4", self.server.decoder.render_metrics())
+        if url.path == "/history" or url.path.startswith("/history/"):
+            try:
+                status, result = self.server.decoder.query_history(url.path.split("/")[2:], parse_qs(url.query))
+            except ValueError as e:
+                status, result = 400, {"error": str(e)}
+            return self._send(status, "application/json", json.dumps(result))
+        self.send_error(404)
+
+    def _send(self, status, content_type, text):
+        body = text.encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+async def _await_logged(awaitable, key):
+    # Awaits what a coroutine callback or handler returned, logging its errors like a plain call's
+    try:
+        await awaitable
+    except Exception:
+        logging.exception(f"Unexpected error in {key}")
+
+
+class Scheduler:
+    # Timer heap run on one thread. Scheduling a key again replaces its pending timer; the
+    # superseded heap entry is skipped when it surfaces
+
+    def __init__(self):
+        self._heap, self._timers = [], {}
+        self._tokens = itertools.count()
+        self._cond = threading.Condition()
+
+    def schedule(self, key, delay, callback, *args):
+        token = next(self._tokens)
+        with self._cond:
+            self._timers[key] = token
+            heapq.heappush(self._heap, (time.monotonic() + delay, token, key, callback, args))
+            self._cond.notify()
+
+    def cancel(self, key):
+        with self._cond:
+            self._timers.pop(key, None)
+
+    def run(self):
+        while True:
+            with self._cond:
+                while True:
+                    if not self._heap:
+                        self._cond.wait()
+                        continue
+                    when, token, key, callback, args = self._heap[0]
+                    if self._timers.get(key) != token:
+                        heapq.heappop(self._heap)
+                        continue
+                    delay = when - time.monotonic()
+                    if delay <= 0:
+                        heapq.heappop(self._heap)
+                        del self._timers[key]
+                        break
+                    self._cond.wait(delay)
+            try:
+                result = callback(*args)
+            except Exception:
+                logging.exception(f"Unexpected error in scheduled {key}")
+                continue
+            if inspect.isawaitable(result):
+                self.spawn(result, key)
+
+    def spawn(self, awaitable, key):
+        # No event loop here: coroutine callbacks run to completion on the calling thread
+        asyncio.run(_await_logged(awaitable, key))
+
+
+class LoopScheduler:
+    # Scheduler API on an asyncio event loop (runtime: asyncio); call it from the loop's thread only.
+    # Awaitables returned by callbacks run as tasks on the loop
+
+    def __init__(self):
+        self.loop = None
+        self._timers = {}
+        self._tasks = set()
+
+    def schedule(self, key, delay, callback, *args):
+        self.cancel(key)
+        self._timers[key] = self.loop.call_later(max(0.0, delay), self._fire, key, callback, args)
+
+    def cancel(self, key):
+        timer = self._timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+
+    def _fire(self, key, callback, args):
+        del self._timers[key]
+        try:
+            result = callback(*args)
+        except Exception:
+            return logging.exception(f"Unexpected error in scheduled {key}")
+        if inspect.isawaitable(result):
+            self.spawn(result, key)
+
+    def spawn(self, awaitable, key):
+        task = self.loop.create_task(_await_logged(awaitable, key))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+
+class CommandTracker:
+    # Commands awaiting an ack, keyed by (device_sn, seq). Unacknowledged commands are handed to
+    # `resend` with exponential backoff until max_retries, unless `reported(device_sn, state)` shows
+    # the device already applied them; a newer command of the same type supersedes the pending one.
+    # The last `remember` resolved seqs are kept so acks arriving after a retry, a newer command or
+    # a timeout are told apart from unknown frames. Timeouts run on the shared scheduler
+
+    def __init__(self, scheduler, timeout, max_retries, resend, reported, max_backoff=60.0, remember=256):
+        self.scheduler = scheduler
+        self.timeout, self.max_retries, self.max_backoff = timeout, max_retries, max_backoff
+        self.resend, self.reported, self.remember = resend, reported, remember
+        self._pending = {}  # (device_sn, seq) -> [attempt, sent_at, cmd_id, pdata, state]
+        self._latest = {}  # (device_sn, cmd_id) -> seq of the newest pending command
+        self._resolved = collections.OrderedDict()  # (device_sn, seq) -> cmd_id, oldest first
+        self._lock = threading.Lock()
+        self.stats = {"acked": 0, "confirmed": 0, "late": 0, "retried": 0, "failed": 0}
+        self.latency = {}  # state key -> [count, total, max] round trip since the last stats log
+
+    def track(self, device_sn, seq, cmd_id, pdata, state, attempt=0):
+        with self._lock:
+            superseded = self._latest.get((device_sn, cmd_id))
+            if superseded is not None and self._pending.pop((device_sn, superseded), None) is not None:
+                self._resolve(device_sn, superseded, cmd_id)
+                self.scheduler.cancel(("ack", device_sn, superseded))
+            self._latest[(device_sn, cmd_id)] = seq
+            self._pending[(device_sn, seq)] = [attempt, time.monotonic(), cmd_id, pdata, state]
+        delay = min(self.timeout * (2 ** attempt), self.max_backoff)
+        self.scheduler.schedule(("ack", device_sn, seq), delay, self._expire, device_sn, seq)
+
+    def acknowledge(self, device_sn, seq, cmd_id):
+        # State of the acked command, or None if the frame does not answer a pending command
+        with self._lock:
+            entry = self._pending.get((device_sn, seq))
+            if entry is None or entry[2] != cmd_id:
+                return None
+            self._forget(device_sn, seq, cmd_id)
+        self.scheduler.cancel(("ack", device_sn, seq))
+        self.stats["acked"] += 1
+        rtt = time.monotonic() - entry[1]
+        latency = self.latency.setdefault(entry[4][0], [0, 0.0, 0.0])
+        latency[0] += 1
+        latency[1] += rtt
+        latency[2] = max(latency[2], rtt)
+        return entry[4]
+
+    def late(self, device_sn, seq, cmd_id):
+        # True (and counted) if the frame acks a command that was already retried, superseded or given up
+        with self._lock:
+            if self._resolved.get((device_sn, seq)) != cmd_id:
+                return False
+        self.stats["late"] += 1
+        return True
+
+    def _forget(self, device_sn, seq, cmd_id):
+        del self._pending[(device_sn, seq)]
+        if self._latest.get((device_sn, cmd_id)) == seq:
+            del self._latest[(device_sn, cmd_id)]
+        self._resolve(device_sn, seq, cmd_id)
+
+    def _resolve(self, device_sn, seq, cmd_id):
+        self._resolved[(device_sn, seq)] = cmd_id
+        if len(self._resolved) > self.remember:
+            self._resolved.popitem(last=False)
+
+    def _expire(self, device_sn, seq):
+        with self._lock:
+            entry = self._pending.get((device_sn, seq))
+            if entry is None:
+                return
+            attempt, _, cmd_id, pdata, state = entry
+            self._forget(device_sn, seq, cmd_id)
+        if self.reported(device_sn, state):
+            # The ack was lost, not the command: the latest heartbeat already shows the value
+            self.stats["confirmed"] += 1
+            return
+        if attempt >= self.max_retries:
+            self.stats["failed"] += 1
+            logging.warning(f"{state[0]} command to {device_sn} not acknowledged after {attempt + 1} attempts")
+            return
+        self.stats["retried"] += 1
+        self.resend(device_sn, cmd_id, pdata, state, attempt + 1)
+
+
+class Debouncer:
+    # Trailing-edge debounce per key on the shared scheduler: only the last value submitted during a
+    # burst is delivered, `window` seconds after the burst goes quiet but never more than `max_delay`
+    # after it started
+
+    def __init__(self, scheduler, window, callback, max_delay=None):
+        self.scheduler = scheduler
+        self.window = window
+        self.max_delay = max(window, max_delay if max_delay is not None else 4 * window)
+        self.callback = callback
+        self._pending = {}  # key -> [latest due, value]
+        self._lock = threading.Lock()
+        self.stats = {"submitted": 0, "delivered": 0}
+
+    def submit(self, key, value):
+        self.stats["submitted"] += 1
+        if self.window <= 0:
+            return self._deliver(key, value)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._pending.get(key)
+            if entry is None:
+                entry = self._pending[key] = [now + self.max_delay, value]
+            else:
+                entry[1] = value
+            self.scheduler.schedule(("debounce", key), min(self.window, entry[0] - now), self._fire, key)
+
+    def _fire(self, key):
+        with self._lock:
+            entry = self._pending.pop(key, None)
+        if entry is not None:
+            self._deliver(key, entry[1])
+
+    def _deliver(self, key, value):
+        self.stats["delivered"] += 1
+        try:
+            result = self.callback(key, value)
+        except Exception:
+            return logging.exception(f"Unexpected error while handling {key}")
+        if inspect.isawaitable(result):
+            self.scheduler.spawn(result, key)
+
+
+class EventBuffer:
+    # Device event records on their way to HA. Reports are deduplicated by (device_sn, event_seq)
+    # against the last `remember` seqs of each device. Records wait in one bounded deque (the oldest
+    # are dropped when it is full) and every `interval` seconds up to `batch_size` per device are
+    # handed to `flush(device_sn, records)`, so a backlog dump drains in batches at a steady rate
+
+    def __init__(self, scheduler, interval, batch_size, max_records, flush, remember=32):
+        self.scheduler = scheduler
+        self.interval, self.batch_size, self.remember = interval, batch_size, remember
+        self.flush = flush
+        self._records = collections.deque(maxlen=max_records)
+        self._seen = {}  # device_sn -> deque of recent event_seq
+        self._armed = False
+        self._lock = threading.Lock()
+        self.stats = {"reports": 0, "duplicates": 0, "records": 0, "dropped": 0, "published": 0}
+
+    def add(self, device_sn, event_seq, records):
+        # False if the report was already seen; records is any iterable, consumed only when new
+        with self._lock:
+            seen = self._seen.get(device_sn)
+            if seen is None:
+                seen = self._seen[device_sn] = collections.deque(maxlen=self.remember)
+            if event_seq in seen:
+                self.stats["duplicates"] += 1
+                return False
+            seen.append(event_seq)
+            self.stats["reports"] += 1
+            buffer = self._records
+            for record in records:
+                if len(buffer) == buffer.maxlen:
+                    self.stats["dropped"] += 1
+                buffer.append((device_sn, record))
+                self.stats["records"] += 1
+            if buffer and not self._armed:
+                self._armed = True
+                self.scheduler.schedule("events", self.interval, self._fire)
+        return True
+
+    def _fire(self):
+        with self._lock:
+            batches, rest = {}, []
+            while self._records:
+                device_sn, record = self._records.popleft()
+                batch = batches.setdefault(device_sn, [])
+                if len(batch) < self.batch_size:
+                    batch.append(record)
+                else:
+                    rest.append((device_sn, record))
+            self._records.extend(rest)
+            self._armed = bool(rest)
+            if rest:
+                self.scheduler.schedule("events", self.interval, self._fire)
+        for device_sn, batch in batches.items():
+            self.stats["published"] += len(batch)
+            try:
+                self.flush(device_sn, batch)
+            except Exception:
+                logging.exception(f"Unexpected error while publishing events for {device_sn}")
+
+
+# Energy counters integrated from heartbeat power: (key, name, power field, sign). Sign picks the
+# positive (1) or negative (-1) part of the power, so every counter only ever increases;
+# bat_input_watts is positive while the battery discharges into the inverter
+ENERGY_COUNTERS = (
+    ("pv1_energy", "PV1 Energy", "pv1_input_watts", 1),
+    ("pv2_energy", "PV2 Energy", "pv2_input_watts", 1),
+    ("bat_charge_energy", "Battery Charge Energy", "bat_input_watts", -1),
+    ("bat_discharge_energy", "Battery Discharge Energy", "bat_input_watts", 1),
+    ("inv_output_energy", "Inverter Output Energy", "inv_output_watts", 1),
+)
+
+
+class EnergyMeter:
+    # Trapezoidal integration of heartbeat power into Wh counters per device (ENERGY_COUNTERS).
+    # Samples more than `max_gap` seconds apart are not integrated across, so an offline period
+    # adds nothing instead of stretching the last reading over it
+
+    def __init__(self, max_gap):
+        self.max_gap = max_gap
+        self.keys = tuple(counter[0] for counter in ENERGY_COUNTERS)
+        self._fields = tuple((HEARTBEAT_CODEC.index[field], HEARTBEAT_CODEC.entries[HEARTBEAT_CODEC.index[field]][3], sign)
+                             for _, _, field, sign in ENERGY_COUNTERS)
+        self._devices = {}  # device_sn -> [last sample time, last powers (W), totals (Wh)]
+
+    def _powers(self, raw):
+        return tuple(max(0.0, sign * raw[i] / scale) for i, scale, sign in self._fields)
+
+    def add(self, device_sn, raw, now):
+        powers = self._powers(raw)
+        state = self._devices.get(device_sn)
+        if state is None:
+            self._devices[device_sn] = [now, powers, [0.0] * len(powers)]
+            return
+        if state[0] is None:
+            state[0], state[1] = now, powers
+            return
+        dt = now - state[0]
+        if dt <= 0:
+            return
+        if dt <= self.max_gap:
+            totals = state[2]
+            for i, (before, after) in enumerate(zip(state[1], powers)):
+                totals[i] += (before + after) * dt / 7200
+        state[0], state[1] = now, powers
+
+    def restore(self, device_sn, totals, raw, last_seen):
+        # Counters from the device file; the saved heartbeat is the previous sample, so a short
+        # restart is integrated across like any other gap within max_gap
+        self._devices[device_sn] = [last_seen, self._powers(raw), [float(totals.get(key, 0.0)) for key in self.keys]]
+
+    def seed(self, device_sn, key, total):
+        # A counter published elsewhere (the previous owner in clustered mode); counters only grow,
+        # so the larger value wins. A device without samples yet starts integrating at its next one
+        state = self._devices.get(device_sn)
+        if state is None:
+            state = self._devices[device_sn] = [None, None, [0.0] * len(self.keys)]
+        i = self.keys.index(key)
+        state[2][i] = max(state[2][i], total)
+
+    def totals(self, device_sn):
+        state = self._devices.get(device_sn)
+        return tuple(state[2]) if state is not None else None
+
+    def forget(self, device_sn):
+        self._devices.pop(device_sn, None)
+
+    def devices(self):
+        return list(self._devices)
+
+
+# Site-wide power sums over online devices: (key, name, heartbeat power fields). Battery power is
+# positive while the batteries discharge, like bat_input_watts
+SITE_SENSORS = (
+    ("pv_power", "PV Power", ("pv1_input_watts", "pv2_input_watts")),
+    ("ac_output_power", "AC Output Power", ("inv_output_watts",)),
+    ("battery_power", "Battery Power", ("bat_input_watts",)),
+)
+SITE_ID = "ecoflow_site"
+
+
+class SiteAggregate:
+    # Running site totals over the devices that currently count (online, and owned in clustered
+    # mode). A heartbeat swaps its device's previous contribution for the new one in O(1): sums are
+    # kept in raw integer units so repeated add/subtract never drifts, and the SOC minimum comes
+    # from a count per SOC percent, so dropping the lowest device needs no rescan of the others
+
     def __init__(self):
-        options_path = Path("/data/options.json")
-        options = json.loads(options_path.read_text()) if options_path.exists() else {}
+        self.fields = tuple({field: None for _, _, fields in SITE_SENSORS for field in fields})
+        self._indexes = tuple(HEARTBEAT_CODEC.index[field] for field in self.fields)
+        self._soc = HEARTBEAT_CODEC.index["bat_soc"]
+        self._contributions = {}  # device_sn -> (raw field values, SOC)
+        self._sums, self._soc_sum, self._soc_counts = [0] * len(self.fields), 0, [0] * 101
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._contributions)
+
+    def update(self, device_sn, raw):
+        values, soc = tuple(raw[i] for i in self._indexes), min(100, max(0, raw[self._soc]))
+        with self._lock:
+            previous = self._contributions.get(device_sn)
+            if previous is not None:
+                self._apply(previous, -1)
+            self._contributions[device_sn] = (values, soc)
+            self._apply((values, soc), 1)
+
+    def remove(self, device_sn):
+        with self._lock:
+            previous = self._contributions.pop(device_sn, None)
+            if previous is not None:
+                self._apply(previous, -1)
+
+    def _apply(self, contribution, sign):
+        values, soc = contribution
+        sums = self._sums
+        for i, value in enumerate(values):
+            sums[i] += sign * value
+        self._soc_sum += sign * soc
+        self._soc_counts[soc] += sign
+
+    def partial(self):
+        # [raw sums, SOC sum, lowest SOC or None, device count]; partials of several cluster members merge
+        with self._lock:
+            soc_min = next((soc for soc, count in enumerate(self._soc_counts) if count), None)
+            return [list(self._sums), self._soc_sum, soc_min, len(self._contributions)]
+
+    def values(self, partials):
+        # Site sensor values from one or more partials, keyed like the site state document
+        sums = [sum(values) for values in zip(*(partial[0] for partial in partials))]
+        soc_sum, count = sum(partial[1] for partial in partials), sum(partial[3] for partial in partials)
+        mins = [partial[2] for partial in partials if partial[2] is not None]
+        totals = dict(zip(self.fields, sums))
+        values = {key: round(sum(totals[field] / HEARTBEAT_CODEC.entries[HEARTBEAT_CODEC.index[field]][3]
+                                 for field in fields), 1)
+                  for key, _, fields in SITE_SENSORS}
+        values["average_soc"] = round(soc_sum / count, 1) if count else None
+        values["min_soc"] = min(mins) if mins else None
+        values["devices_online"] = count
+        return values
+
+
+class HistoryRing:
+    # Preallocated ring of samples for one device: arrival times plus one typed array per field
+    __slots__ = ("times", "columns", "next", "count")
+
+    def __init__(self, capacity, typecodes):
+        self.times = array("d", bytes(8 * capacity))
+        self.columns = tuple(array(code, bytes(array(code).itemsize * capacity)) for code in typecodes)
+        self.next = self.count = 0
+
+
+class History:
+    # Recent heartbeat samples per device for the measurement fields (those with a unit and a numeric
+    # scale) of a codec, `capacity` samples deep. Rings are allocated on a device's first sample, so
+    # memory is bytes_per_device per known device and never grows after that
+
+    def __init__(self, capacity, codec):
+        self.capacity = capacity
+        entries = [entry for entry in codec.entries if entry[4] and not callable(entry[3])]
+        self.keys = tuple(entry[1] for entry in entries)
+        self._scales = {entry[1]: entry[3] for entry in entries}
+        self._typecodes = tuple(PACKED_TYPES[codec.message_type.DESCRIPTOR.fields_by_name[key].type] for key in self.keys)
+        self._getter = operator.itemgetter(*(HEARTBEAT_CODEC.index[key] for key in self.keys))
+        self._rings = {}
+        self._lock = threading.Lock()
+        self.bytes_per_device = capacity * (8 + sum(array(code).itemsize for code in self._typecodes))
+
+    def __len__(self):
+        return len(self._rings)
+
+    def add(self, device_sn, now, raw):
+        # raw: heartbeat values aligned with HEARTBEAT_CODEC.keys
+        with self._lock:
+            ring = self._rings.get(device_sn)
+            if ring is None:
+                ring = self._rings[device_sn] = HistoryRing(self.capacity, self._typecodes)
+            i = ring.next
+            ring.times[i] = now
+            for column, value in zip(ring.columns, self._getter(raw)):
+                column[i] = value
+            ring.next = (i + 1) % self.capacity
+            ring.count = min(ring.count + 1, self.capacity)
+
+    def forget(self, device_sn):
+        with self._lock:
+            self._rings.pop(device_sn, None)
+
+    def devices(self):
+        return list(self._rings)
+
+    def query(self, device_sn, key, seconds=None, last=None, points=None):
+        # Stats over the window plus either the last N samples or a series downsampled to N points
+        # (mean of each run of samples, stamped with the run's last time); None for unknown device/field
+        if key not in self._scales:
+            return None
+        column = self.keys.index(key)
+        with self._lock:
+            ring = self._rings.get(device_sn)
+            if ring is None:
+                return None
+            start = (ring.next - ring.count) % self.capacity
+            order = [(start + i) % self.capacity for i in range(ring.count)]
+            times, values = [ring.times[i] for i in order], [ring.columns[column][i] for i in order]
+        if seconds is not None:
+            first = bisect.bisect_left(times, time.time() - seconds)
+            times, values = times[first:], values[first:]
+        scale = self._scales[key]
+        values = [value / scale for value in values] if scale != 1 else values
+        result = {"device_sn": device_sn, "field": key, "count": len(values)}
+        if values:
+            result.update(min=min(values), max=max(values), mean=sum(values) / len(values), last=values[-1])
+        if last is not None:
+            result["samples"] = [[t, v] for t, v in zip(times[-last:], values[-last:])] if last > 0 else []
+        if points is not None and points > 0:
+            step = max(1, -(-len(values) // points))
+            result["series"] = [[times[min(i + step, len(values)) - 1], sum(values[i:i + step]) / len(values[i:i + step])]
+                                for i in range(0, len(values), step)]
+        return result
+
+
+class DeviceRecord:
+    # One known device. `state` is a DEVICE_STATE packed bytes record that is only ever replaced
+    # as a whole, so readers never see values from one heartbeat with the timestamp of another
+    __slots__ = ("device_sn", "short_name", "state", "online")
+
+    def __init__(self, device_sn, short_name):
+        self.device_sn, self.short_name = device_sn, short_name
+        self.state = None
+        self.online = True
+
+    @property
+    def last_seen(self):
+        state = self.state
+        return DEVICE_STATE_SEEN.unpack_from(state)[0] if state is not None else None
+
+    def raw(self):
+        # Unscaled heartbeat values aligned with HEARTBEAT_CODEC.keys, or None before the first heartbeat
+        state = self.state
+        return DEVICE_STATE.unpack(state)[1:] if state is not None else None
+
+
+class DeviceRegistry:
+    # Device records by serial plus a short name index. Both dicts are copy-on-write: a writer builds
+    # a new dict under the lock and swaps it in, so readers iterate snapshots without locking.
+    # Short names use the last 4 serial characters unless another device already holds them, in
+    # which case a longer suffix is used
+
+    def __init__(self):
+        self._records, self._serials = {}, {}
+        self._lock = threading.Lock()
+        self.changes = 0  # bumped on every update, so persistence can skip unchanged registries
+
+    def __len__(self):
+        return len(self._records)
+
+    def get(self, device_sn):
+        return self._records.get(device_sn)
+
+    def snapshot(self):
+        # Current serial -> DeviceRecord mapping; never mutated after it is published
+        return self._records
+
+    def record(self, device_sn):
+        record = self._records.get(device_sn)
+        if record is None:
+            record = self._register(device_sn)
+        return record
+
+    def short_name(self, device_sn):
+        return self.record(device_sn).short_name
+
+    def resolve(self, short_name):
+        return self._serials.get(short_name)
+
+    def update(self, device_sn, raw, last_seen):
+        # Store a heartbeat's raw values; True if this is the device's first heartbeat
+        record = self.record(device_sn)
+        is_new = record.state is None
+        record.state = DEVICE_STATE.pack(last_seen, *raw)
+        self.changes += 1
+        return is_new
+
+    def remove(self, device_sn):
+        with self._lock:
+            record = self._records.get(device_sn)
+            if record is None:
+                return
+            self._serials = {k: v for k, v in self._serials.items() if k != record.short_name}
+            self._records = {k: v for k, v in self._records.items() if k != device_sn}
+            self.changes += 1
+
+    def _register(self, device_sn):
+        with self._lock:
+            record = self._records.get(device_sn)
+            if record is not None:
+                return record
+            for length in range(4, len(device_sn) + 1):
+                short_name = f"ps{device_sn[-length:].lower()}"
+                if short_name not in self._serials:
+                    break
+            else:
+                raise ValueError(f"No unique short name available for {device_sn}")
+            if length > 4:
+                logging.warning(f"{device_sn} shares its last 4 characters with {self._serials[f'ps{device_sn[-4:].lower()}']}; "
+                                f"using short name {short_name}")
+            record = DeviceRecord(device_sn, short_name)
+            self._serials = {**self._serials, short_name: device_sn}
+            self._records = {**self._records, device_sn: record}
+            return record
+
+
+def _rendezvous(member_id, device_sn):
+    # Rendezvous (highest random weight) score; crc32 rather than hash() so every process agrees
+    return zlib.crc32(f"{member_id}/{device_sn}".encode())
+
+
+class Cluster:
+    # Members of a cluster_group and the owner of each device. Members announce themselves on a
+    # retained topic every `interval` seconds and their will clears it; one not heard from for
+    # CLUSTER_EXPIRY intervals is dropped. The owner is the member with the highest rendezvous
+    # score, so every member computes the same owner from the same list and a membership change
+    # only moves the devices of the member that joined or left. (members, owners) is swapped as
+    # one tuple, so owner() never caches an owner computed from an older member list
+
+    def __init__(self, group, member_id, interval):
+        self.group, self.member_id, self.interval = group, member_id, interval
+        self.prefix = f"ecoflow_decoder/{group}"
+        self.member_topic = f"{self.prefix}/members/{member_id}"
+        self.inbox = f"{self.prefix}/{member_id}/upstream/"
+        self.ready = False  # False until the retained member list has arrived after a connect
+        self.leaving = False
+        self._seen = {member_id: time.monotonic()}
+        self._view = ((member_id,), {})
+        self._lock = threading.Lock()
+        self.stats = {"forwarded": 0, "rebalances": 0}
+
+    @property
+    def members(self):
+        return self._view[0]
+
+    def owner(self, device_sn):
+        members, owners = self._view
+        owner = owners.get(device_sn)
+        if owner is None:
+            owner = owners[device_sn] = max(members, key=lambda member_id: _rendezvous(member_id, device_sn))
+        return owner
+
+    def update(self, member_id, present, now):
+        # Announcement (present) or cleared announcement of a member; True if the member list changed
+        with self._lock:
+            if present:
+                self._seen[member_id] = now
+            elif member_id != self.member_id:
+                self._seen.pop(member_id, None)
+            return self._refresh()
+
+    def expire(self, now):
+        with self._lock:
+            cutoff = now - CLUSTER_EXPIRY * self.interval
+            self._seen = {member_id: seen for member_id, seen in self._seen.items()
+                          if seen >= cutoff or member_id == self.member_id}
+            return self._refresh()
+
+    def _refresh(self):
+        members = tuple(sorted(self._seen))
+        if members == self._view[0]:
+            return False
+        self._view = (members, {})
+        self.stats["rebalances"] += 1
+        return True
+
+
+class EcoflowDecoder:
+    def __init__(self, options=None):
+        if options is None:
+            options_path = Path("/data/options.json")
+            options = json.loads(options_path.read_text()) if options_path.exists() else {}
         self.mqtt_host = options.get("mqtt_host", "core-mosquitto")
         self.mqtt_port = options.get("mqtt_port", 1883)
         self.mqtt_user = options.get("mqtt_user", "")
         self.mqtt_password = options.get("mqtt_password", "")
         self.topic = "/sys/75/+/thing/protobuf/upstream"
-        self.heartbeats, self.last_seen, self.last_limit_value = {}, {}, {}
-        self.device_online = {}
-        self.offline_timeout, self.discovery_interval, self.heartbeat_interval = 300, 300, 30
-        self.heartbeat_logging = options.get("heartbeat_logging", False)
-        self.control_logging = options.get("control_logging", False)
-        self.client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+        self.devices = DeviceRegistry()
+        self.commands = CommandEncoder()
+        # "threads": paho network thread plus worker threads, "asyncio": everything on one event loop
+        self.runtime = options.get("runtime", "threads")
+        if self.runtime not in RUNTIMES:
+            logging.warning(f"Unknown runtime '{self.runtime}', using 'threads'")
+            self.runtime = "threads"
+        self.decode_in_executor = options.get("decode_in_executor", False)
+        self.scheduler = LoopScheduler() if self.runtime == "asyncio" else Scheduler()
+        # Bursts of /set messages per device and control collapse to their final value
+        self.controls = Debouncer(self.scheduler, float(options.get("control_debounce", 0.5)), self._run_control)
+        self.pending_commands = CommandTracker(self.scheduler, float(options.get("command_ack_timeout", 5.0)),
+                                               int(options.get("command_retries", 3)), self._send_command,
+                                               self._command_reported)
+        self.events = EventBuffer(self.scheduler, float(options.get("event_batch_interval", 1.0)),
+                                  max(1, int(options.get("event_batch_size", 20))),
+                                  max(1, int(options.get("event_buffer_size", 500))), self._publish_events)
+        self._control_handlers = {key: getattr(self, name) for key, name in CONTROL_HANDLERS.items()}
+        self._frame_publishers = {entry[0]: getattr(self, entry[3]) for entry in FRAME_DECODERS.values()}
+        self._frame_publishers["ack"] = self._acknowledge
+        # Topics can only be filtered by serial while every decoder is keyed by serial prefix
+        prefixes = {key[0] for key in FRAME_DECODERS}
+        self._topic_prefixes = frozenset(prefixes) if all(isinstance(p, str) for p in prefixes) else None
+        self._discovery_cache, self._discovery_published = {}, {}
+        self.offline_timeout = float(options.get("offline_timeout", 300))
+        self.discovery_interval = float(options.get("discovery_interval", 300))
+        self.heartbeat_interval = float(options.get("heartbeat_interval", 30))
+        # heartbeat_logging/control_logging lines go through a sampled, rate-limited tracer
+        categories = (("frames", "heartbeats") if options.get("heartbeat_logging", False) else ()) + \
+                     (("controls",) if options.get("control_logging", False) else ())
+        device_rates = {}
+        for entry in options.get("trace_devices", []):
+            device, _, rate = entry.rpartition(":")
+            try:
+                device_rates[device if device.startswith("ps") else device.upper()] = float(rate)
+            except ValueError:
+                logging.warning(f"Ignoring trace_devices entry '{entry}' (expected <serial or short name>:<rate>)")
+        self.tracer = Tracer(categories, float(options.get("trace_sample_rate", 1.0)), device_rates,
+                             float(options.get("trace_rate_limit", 5)), float(options.get("trace_burst", 20)),
+                             int(options.get("trace_buffer_size", 100)))
+        # Change-only state publishing: last published (value, time) per device and topic
+        self.state_max_age = options.get("state_max_age", 300)
+        deadbands = {unit: float(options.get(opt, 0.0)) for unit, opt in DEADBAND_OPTIONS.items()}
+        self._configure_fields(options)
+        # State values are the profile's codec fields followed by the control-only values
+        self._state_keys = self.codec.keys + ("power_limit", "supply_mode")
+        self._state_deadbands = tuple(deadbands.get(entry[4], 0.0) for entry in self.codec.entries) + (0.0, 0.0)
+        self._state_cache, self._state_topic_cache = {}, {}
+        # "topics": one retained topic per entity, "json": one JSON document per device
+        self.state_mode = options.get("state_mode", "topics")
+        if self.state_mode not in STATE_MODES:
+            logging.warning(f"Unknown state_mode '{self.state_mode}', using 'topics'")
+            self.state_mode = "topics"
+        self.state_stats = {"published": 0, "suppressed": 0}
+        # Network thread -> decode workers (every frame, in order) -> publisher (latest per device and decoder)
+        self.pipeline_workers = max(1, int(options.get("pipeline_workers", 1)))
+        queue_size = max(1, int(options.get("pipeline_queue_size", 256)))
+        self._decode_queue, self._publish_queue = FrameQueue(queue_size), CoalescingQueue(queue_size)
+        self._frame_seq, self._published_seq = 0, {}
+        self.pipeline_latency = {stage: [0, 0.0, 0.0] for stage in ("decode", "publish", "total")}
+        # Hot-path metrics: plain counters and lock-free histograms, rendered on demand
+        self.metrics_port = int(options.get("metrics_port", 0))
+        capture_file = options.get("capture_file", "")
+        self.capture = CaptureWriter(capture_file) if capture_file else None
+        # Known devices survive restarts; saved at most every device_save_interval seconds
+        device_file = options.get("device_file", "/data/devices.json")
+        self.device_store = DeviceStore(device_file, float(options.get("device_expiry", 604800))) if device_file else None
+        self.device_save_interval = float(options.get("device_save_interval", 60))
+        self._devices_saved = 0
+        # Wh counters integrated per heartbeat, published every energy_interval seconds (0 = off)
+        self.energy_interval = float(options.get("energy_interval", 60))
+        self.energy = EnergyMeter(self.offline_timeout)
+        self._energy_published = {}
+        # Recent samples per device and measurement field, queried over HTTP on metrics_port
+        history_size = int(options.get("history_size", 0))
+        self.history = History(history_size, self.codec) if history_size > 0 else None
+        # Site totals over the online devices, published as one "EcoFlow Site" device every site_interval seconds (0 = off)
+        self.site_interval = float(options.get("site_interval", 0))
+        self.site = SiteAggregate() if self.site_interval > 0 else None
+        self._site_published, self._site_partials = None, {}
+        # Clustered mode: upstream frames arrive through a shared subscription and are forwarded to
+        # the member that owns the device, which alone sends its heartbeats and commands
+        cluster_group = str(options.get("cluster_group") or "").translate(TOPIC_UNSAFE)
+        member_id = options.get("cluster_member_id") or f"{os.uname().nodename}-{os.urandom(3).hex()}"
+        self.cluster = (Cluster(cluster_group, str(member_id).translate(TOPIC_UNSAFE), float(options.get("cluster_interval", 30)))
+                        if cluster_group else None)
+        self.subscription = f"$share/{cluster_group}/{self.topic}" if self.cluster is not None else self.topic
+        # Owned devices, and those claimed whose availability this member has not announced yet
+        self._owned, self._unannounced, self._energy_seeding = set(), set(), {}
+        self.metrics = {"received": 0, "filtered": 0, "unknown_frames": {}, "decode_errors": {}, "commands_sent": {}}
+        latency_buckets = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01)
+        self.parse_latency = {name: Histogram(latency_buckets)
+                              for name in ("HeaderMessage", *(entry[0] for entry in FRAME_DECODERS.values()))}
+        self.publishes_per_heartbeat = Histogram((0, 1, 2, 5, 10, 20, 40, 80))
+        self._configure_mqtt(options)
+
+    def _configure_mqtt(self, options):
+        # mqtt_protocol "5" adds topic aliases and message expiry; publish_policy entries are "class:qos:retain"
+        self.mqtt_protocol = str(options.get("mqtt_protocol", "3.1.1"))
+        if self.mqtt_protocol not in PUBLISH_POLICIES:
+            logging.warning(f"Unknown mqtt_protocol '{self.mqtt_protocol}', using '3.1.1'")
+            self.mqtt_protocol = "3.1.1"
+        self.mqtt5 = self.mqtt_protocol == "5"
+        self.publish_policy = dict(PUBLISH_POLICIES[self.mqtt_protocol])
+        for entry in options.get("publish_policy", []):
+            try:
+                cls, qos, retain = entry.split(":")
+                if cls not in self.publish_policy or qos not in ("0", "1", "2") or retain not in ("true", "false"):
+                    raise ValueError
+            except ValueError:
+                logging.warning(f"Ignoring publish_policy entry '{entry}' (expected <class>:<qos>:<true|false>, "
+                                f"classes {', '.join(self.publish_policy)})")
+                continue
+            self.publish_policy[cls] = (int(qos), retain == "true")
+        self.message_expiry = int(options.get("message_expiry", 600))
+        # topic -> (topic to send, properties); aliased topics send an empty topic after first use
+        self._topic_properties, self._next_alias, self._alias_maximum = {}, 1, 0
+        self._alias_lock = threading.Lock()
+        self.client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, protocol=mqtt.MQTTv5 if self.mqtt5 else mqtt.MQTTv311)
         self.client.reconnect_delay_set(min_delay=1, max_delay=30)
         if self.mqtt_user:
             self.client.username_pw_set(self.mqtt_user, self.mqtt_password)
         self.client.on_connect, self.client.on_message = self.on_connect, self.on_message
+        self.client.on_disconnect = self.on_disconnect
+        if self.cluster is not None:
+            # An empty retained announcement removes this member from everyone's list
+            self.client.will_set(self.cluster.member_topic, "", *self.publish_policy["cluster"])
+
+    def _publish(self, cls, topic, payload=None):
+        # Every publish goes through here so the class's QoS/retain policy applies. Under MQTT 5, QoS 0
+        # topics of ALIASED_CLASSES get a topic alias while the broker's maximum allows (full topic on
+        # first use, empty topic after) and EXPIRING_CLASSES carry message_expiry
+        qos, retain = self.publish_policy[cls]
+        if not self.mqtt5:
+            return self.client.publish(topic, payload, qos=qos, retain=retain)
+        entry = self._topic_properties.get(topic)
+        if entry is None:
+            with self._alias_lock:
+                entry = self._topic_properties.get(topic)
+                if entry is None:
+                    return self._publish_first(cls, topic, payload, qos, retain)
+        return self.client.publish(entry[0], payload, qos=qos, retain=retain, properties=entry[1])
+
+    def _publish_first(self, cls, topic, payload, qos, retain):
+        properties = Properties(PacketTypes.PUBLISH)
+        if cls in EXPIRING_CLASSES and self.message_expiry > 0:
+            properties.MessageExpiryInterval = self.message_expiry
+        alias = None
+        if cls in ALIASED_CLASSES and qos == 0 and self._next_alias <= self._alias_maximum:
+            alias = properties.TopicAlias = self._next_alias
+        result = self.client.publish(topic, payload, qos=qos, retain=retain, properties=properties)
+        # Only an alias the broker has actually seen with its topic may be used on its own
+        if alias is None:
+            self._topic_properties[topic] = (topic, properties)
+        elif result.rc == mqtt.MQTT_ERR_SUCCESS:
+            self._next_alias += 1
+            self._topic_properties[topic] = ("", properties)
+        return result
+
+    def _reset_aliases(self, alias_maximum=0):
+        with self._alias_lock:
+            self._topic_properties.clear()
+            self._next_alias, self._alias_maximum = 1, alias_maximum
+
+    def _configure_fields(self, options):
+        # Entity profile plus include/exclude lists decide which heartbeat fields become sensors
+        self.entity_profile = options.get("entity_profile", "full")
+        if self.entity_profile not in ENTITY_PROFILES:
+            logging.warning(f"Unknown entity_profile '{self.entity_profile}', using 'full'")
+            self.entity_profile = "full"
+        include, exclude = set(options.get("include_fields", [])), set(options.get("exclude_fields", []))
+        unknown = sorted((include | exclude) - set(HEARTBEAT_CODEC.keys))
+        if unknown:
+            logging.warning(f"Ignoring unknown heartbeat fields in include/exclude lists: {', '.join(unknown)}")
+        profile_fields = ENTITY_PROFILES[self.entity_profile]
+        self.sensor_fields = frozenset(
+            key for key in HEARTBEAT_CODEC.keys
+            if (profile_fields is None or key in profile_fields or key in include) and key not in exclude)
+        # Control entities read their state from heartbeat fields even when the sensor is dropped
+        control_fields = {key for key in CONTROL_STATES if key in HEARTBEAT_CODEC.index}
+        self.codec = HEARTBEAT_CODEC.select(self.sensor_fields | control_fields)
+        self._codec_raw = operator.itemgetter(*(HEARTBEAT_CODEC.index[key] for key in self.codec.keys))
+        self.show_hidden = self.entity_profile == "diagnostic"
 
     def start(self):
+        self.restore_devices()
         logging.info(f"Connecting to MQTT broker {self.mqtt_host}:{self.mqtt_port}...")
         self.client.connect(self.mqtt_host, self.mqtt_port, 60)
         self.client.loop_start()
-        threading.Thread(target=self.loop_discovery, daemon=True).start()
-        threading.Thread(target=self.loop_offline_check, daemon=True).start()
-        threading.Thread(target=self.loop_heartbeat, daemon=True).start()
-        while True: time.sleep(1)
-
-    def loop_discovery(self):
-        while True: time.sleep(self.discovery_interval); self.republish_discovery()
-
-    def loop_offline_check(self):
-        while True: time.sleep(60); self.check_device_offline()
-
-    def loop_heartbeat(self):
-        while True: time.sleep(self.heartbeat_interval); self.send_inverter_heartbeat()
+        self._start_metrics_server()
+        for _ in range(self.pipeline_workers):
+            threading.Thread(target=self.loop_decode, daemon=True).start()
+        threading.Thread(target=self.loop_publish, daemon=True).start()
+        self.scheduler.schedule("discovery", self.discovery_interval, self.discovery_tick)
+        self.scheduler.schedule("save_devices", self.device_save_interval, self.save_devices_tick)
+        if self.energy_interval > 0:
+            self.scheduler.schedule("energy", self.energy_interval, self.energy_tick)
+        if self.site is not None:
+            self.scheduler.schedule("site", self.site_interval, self.site_tick)
+        if self.cluster is not None:
+            self.scheduler.schedule("cluster", self.cluster.interval, self.cluster_tick)
+        threading.Thread(target=self.scheduler.run, daemon=True).start()
+        # Leave through the finally block on SIGTERM so the device file is current for the next start
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            while True: time.sleep(1)
+        finally:
+            self.leave_cluster(timeout=2)
+            if self.capture is not None:
+                # Frames are captured on the network thread; stop it before closing the file and index
+                self.client.disconnect()
+                self.client.loop_stop()
+                self.capture.close()
+            self.save_devices()
+
+    def _start_metrics_server(self):
+        if self.history is not None:
+            history = self.history
+            logging.info(f"Keeping {history.capacity} samples of {len(history.keys)} fields per device "
+                         f"({history.bytes_per_device / 1024:.0f} KiB per device)")
+            if not self.metrics_port:
+                logging.warning("history_size is set but metrics_port is 0; the history API is not served")
+        if self.metrics_port:
+            server = ThreadingHTTPServer(("", self.metrics_port), MetricsHandler)
+            server.daemon_threads, server.decoder = True, self
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            logging.info(f"Serving metrics on port {self.metrics_port}")
+
+    def discovery_tick(self):
+        self.scheduler.schedule("discovery", self.discovery_interval, self.discovery_tick)
+        self.republish_discovery()
+        self._log_stats()
+        self._flush_capture()
+
+    def _log_stats(self):
+        # Counters of the last discovery interval, one log line per area that saw activity
+        self._log_state_stats()
+        self._log_pipeline_stats()
+        self._log_command_stats()
+        self._log_event_stats()
+        self._log_trace_stats()
+
+    def restore_devices(self):
+        # Warm start: known serials, last heartbeat values and last-seen times from the device file,
+        # so outbound heartbeats and control routing work before the devices report again
+        if self.device_store is None:
+            return
+        now = time.time()
+        for device_sn, raw, last_seen, entry in self.device_store.load():
+            self.devices.update(device_sn, raw, last_seen)
+            if "energy" in entry:
+                self.energy.restore(device_sn, entry["energy"], raw, last_seen)
+            self._track_device(device_sn)
+            remaining = last_seen + self.offline_timeout - now
+            self.devices.record(device_sn).online = remaining > 0
+            if remaining > 0:
+                self.scheduler.schedule(("offline", device_sn), remaining, self.check_device_offline, device_sn)
+        self._devices_saved = self.devices.changes
+        if len(self.devices):
+            logging.info(f"Restored {len(self.devices)} EcoFlow devices from {self.device_store.path}")
+
+    def save_devices_tick(self):
+        self.scheduler.schedule("save_devices", self.device_save_interval, self.save_devices_tick)
+        self.expire_devices()
+        self.save_devices()
+
+    def save_devices(self):
+        changes = self.devices.changes
+        if self.device_store is None or changes == self._devices_saved:
+            return
+        try:
+            energy = {sn: {"energy": dict(zip(self.energy.keys, self.energy.totals(sn)))} for sn in self.energy.devices()}
+            self.device_store.save(self.devices.snapshot().values(), energy)
+            self._devices_saved = changes
+        except OSError as e:
+            logging.warning(f"Failed to save device state to {self.device_store.path}: {e}")
+
+    def expire_devices(self):
+        # Devices silent for longer than device_expiry stop getting heartbeats and are forgotten
+        if self.device_store is None or self.device_store.expiry <= 0:
+            return
+        cutoff = time.time() - self.device_store.expiry
+        for device_sn, record in self.devices.snapshot().items():
+            last_seen = record.last_seen
+            if last_seen is not None and last_seen < cutoff:
+                logging.info(f"{device_sn} not seen for {self.device_store.expiry:.0f}s, forgetting it")
+                self.scheduler.cancel(("heartbeat", device_sn))
+                self.scheduler.cancel(("offline", device_sn))
+                self._state_cache.pop(device_sn, None)
+                self._owned.discard(device_sn)
+                self._unannounced.discard(device_sn)
+                self._energy_seeding.pop(device_sn, None)
+                if self.site is not None:
+                    self.site.remove(device_sn)
+                self.energy.forget(device_sn)
+                self._energy_published.pop(device_sn, None)
+                if self.history is not None:
+                    self.history.forget(device_sn)
+                self.devices.remove(device_sn)
 
     def on_connect(self, client, userdata, flags, reason_code, properties=None):
         logging.info(f"Connected to MQTT broker (reason_code={reason_code})")
-        client.subscribe(self.topic)
+        # Topic aliases only live as long as the connection
+        self._reset_aliases(getattr(properties, "TopicAliasMaximum", 0) if self.mqtt5 else 0)
+        client.subscribe(self.subscription)
+        client.subscribe("homeassistant/status")
         client.subscribe("homeassistant/number/+/set")
         client.subscribe("homeassistant/select/+/set")
-        client.message_callback_add("homeassistant/number/+/set", self.on_number_update)
-        client.message_callback_add("homeassistant/select/+/set", self.on_supply_mode_change)
+        client.message_callback_add("homeassistant/number/+/set", self.on_control_set)
+        client.message_callback_add("homeassistant/select/+/set", self.on_control_set)
+        client.message_callback_add("homeassistant/status", self.on_ha_status)
+        if self.tracer.frames is not None:
+            client.subscribe(f"{TRACE_TOPIC}/dump")
+            client.message_callback_add(f"{TRACE_TOPIC}/dump", self.on_trace_dump)
+        if self.site is None:
+            # A site device left on the broker from when site_interval was set is removed once
+            client.subscribe(f"homeassistant/sensor/{SITE_ID}/+/config")
+            client.message_callback_add(f"homeassistant/sensor/{SITE_ID}/+/config", self.on_stale_site_config)
+        # Sensors of fields outside the profile, and energy counters while energy_interval is 0, left
+        # on the broker by an earlier configuration
+        stale_keys = [key for key in HEARTBEAT_CODEC.keys if key not in self.sensor_fields]
+        if self.energy_interval <= 0:
+            stale_keys += [key for key, _, _, _ in ENERGY_COUNTERS]
+        for key in stale_keys:
+            client.subscribe(f"homeassistant/sensor/+/{key}/config")
+            client.message_callback_add(f"homeassistant/sensor/+/{key}/config", self.on_stale_config)
+        if self.cluster is not None:
+            # Ownership is only known once the retained member list is in; the resync waits for it
+            cluster = self.cluster
+            client.subscribe(f"{cluster.prefix}/members/+")
+            client.subscribe(f"{cluster.inbox}+")
+            client.message_callback_add(f"{cluster.prefix}/members/+", self.on_cluster_member)
+            client.message_callback_add("homeassistant/sensor/+/+/state", self.on_energy_seed)
+            if self.site is not None:
+                client.subscribe(f"{cluster.prefix}/site/+")
+                client.message_callback_add(f"{cluster.prefix}/site/+", self.on_site_partial)
+            self._announce()
+            self.scheduler.schedule("cluster_settle", CLUSTER_SETTLE, self._cluster_settled)
+            return
+        # The broker may have lost retained configs while we were disconnected
+        self._schedule_resync()
+
+    def on_disconnect(self, client, userdata, flags, reason_code, properties=None):
+        self._reset_aliases()
+        if self.cluster is not None:
+            self.cluster.ready = False
 
-    def on_number_update(self, client, userdata, msg):
-        topic, payload = msg.topic, msg.payload.decode()
-        if "_battery_lower_limit/set" in topic: self.on_lower_limit_change(client, userdata, msg)
-        elif "_battery_upper_limit/set" in topic: self.on_upper_limit_change(client, userdata, msg)
-        elif "_inverter_brightness/set" in topic: self.on_brightness_change(client, userdata, msg)
-        else: self.on_slider_change_raw(client, userdata, msg)
+    def _announce(self):
+        if self.cluster.leaving:
+            return
+        self._publish("cluster", self.cluster.member_topic, json.dumps({"devices": len(self._owned)}))
+
+    def cluster_tick(self):
+        self.scheduler.schedule("cluster", self.cluster.interval, self.cluster_tick)
+        self._announce()
+        if self.cluster.expire(time.monotonic()):
+            self._rebalance()
+
+    def leave_cluster(self, timeout=0):
+        # Clear the announcement on a clean shutdown (a clean disconnect suppresses the will), so the
+        # other members take over this member's devices right away
+        if self.cluster is None:
+            return
+        self.cluster.leaving = True
+        info = self._publish("cluster", self.cluster.member_topic, "")
+        if timeout:
+            try:
+                info.wait_for_publish(timeout)
+            except (ValueError, RuntimeError):
+                pass
+
+    def _cluster_settled(self):
+        self.cluster.ready = True
+        self._rebalance()
+        self.republish_discovery(force=True)
+
+    def on_cluster_member(self, client, userdata, msg):
+        member_id = msg.topic.rpartition("/")[2]
+        if member_id == self.cluster.member_id and not msg.payload:
+            # A will left by an earlier run under the same member id; announce again
+            return self._announce()
+        if self.cluster.update(member_id, bool(msg.payload), time.monotonic()):
+            self._rebalance()
+
+    def _owns(self, device_sn):
+        cluster = self.cluster
+        return cluster is None or (cluster.ready and cluster.owner(device_sn) == cluster.member_id)
+
+    def _rebalance(self):
+        # The member list changed: release devices now owned elsewhere and take over the new ones
+        cluster = self.cluster
+        if not cluster.ready:
+            return
+        # Records without a heartbeat yet (registered for an event report) are claimed on their first one
+        owned = {device_sn for device_sn, record in self.devices.snapshot().items()
+                 if record.state is not None and self._owns(device_sn)}
+        for device_sn in self._owned - owned:
+            self._release_device(device_sn)
+        for device_sn in owned - self._owned:
+            self._claim_device(device_sn)
+        logging.info(f"Cluster {cluster.group}: {len(cluster.members)} members ({', '.join(cluster.members)}), "
+                     f"{len(owned)} of {len(self.devices)} devices owned by {cluster.member_id}")
+
+    def _claim_device(self, device_sn):
+        self._owned.add(device_sn)
+        self._state_cache.pop(device_sn, None)
+        self._energy_published.pop(device_sn, None)
+        self._publish_discovery(device_sn)
+        self._unannounced.add(device_sn)
+        # The previous owner had the recent heartbeats; give the device a full timeout to show up here
+        self.scheduler.schedule(("offline", device_sn), self.offline_timeout, self.check_device_offline, device_sn)
+        if self.energy_interval > 0:
+            # Continue from the previous owner's retained energy states instead of restarting the counters
+            self._energy_seeding[device_sn] = time.monotonic() + CLUSTER_SEED_WAIT
+            base_topic = f"homeassistant/sensor/ecoflow_{self._short_name(device_sn)}"
+            for key in self.energy.keys:
+                self.client.subscribe(f"{base_topic}/{key}/state")
+
+    def _release_device(self, device_sn):
+        self._owned.discard(device_sn)
+        self._unannounced.discard(device_sn)
+        self._state_cache.pop(device_sn, None)
+        self._energy_published.pop(device_sn, None)
+        self._energy_seeding.pop(device_sn, None)
+        if self.site is not None:
+            self.site.remove(device_sn)
+
+    def on_site_partial(self, client, userdata, msg):
+        # Site sums of another member, merged by the member that publishes the site device
+        try:
+            self._site_partials[msg.topic.rpartition("/")[2]] = json.loads(msg.payload)
+        except ValueError:
+            return
+
+    def on_energy_seed(self, client, userdata, msg):
+        # Retained energy state of a device just taken over: homeassistant/sensor/ecoflow_<short>/<key>/state
+        client.unsubscribe(msg.topic)
+        parts = msg.topic.split("/")
+        device_sn = self.devices.resolve(parts[2][len("ecoflow_"):])
+        if device_sn is None or parts[3] not in self.energy.keys:
+            return
+        try:
+            self.energy.seed(device_sn, parts[3], float(msg.payload))
+        except ValueError:
+            return
+
+    def on_stale_site_config(self, client, userdata, msg):
+        # Retained site config while site_interval is 0; clearing it also stops the broker sending it
+        if msg.retain and msg.payload:
+            self._publish("discovery", msg.topic, "")
+
+    def on_stale_config(self, client, userdata, msg):
+        # Retained config of a device sensor this configuration no longer creates: clear it and its last
+        # state once; the broker then stops sending it
+        if not (msg.retain and msg.payload and msg.topic.split("/")[2].startswith("ecoflow_ps")):
+            return
+        self._publish("discovery", msg.topic, "")
+        self._publish("discovery", f"{msg.topic.rpartition('/')[0]}/state", "")
+
+    def on_ha_status(self, client, userdata, msg):
+        # Home Assistant birth message: resync discovery after an HA restart
+        if msg.payload.decode() == "online":
+            self._schedule_resync()
+
+    def _schedule_resync(self):
+        # A full resync builds and publishes every config: run it on the scheduler instead of the
+        # network thread, so inbound frames keep flowing. Resyncs requested meanwhile collapse into one
+        self.scheduler.schedule("resync", 0, self.republish_discovery, True)
+
+    def on_control_set(self, client, userdata, msg):
+        # homeassistant/<component>/ecoflow_<short name>_<object id>/set, parsed once and dispatched by table
+        parts = msg.topic.split("/")
+        if len(parts) != 4 or not parts[2].startswith("ecoflow_"):
+            return
+        short_name, _, object_id = parts[2][len("ecoflow_"):].partition("_")
+        handler = self._control_handlers.get((parts[1], object_id))
+        device_sn = self.devices.resolve(short_name)
+        if handler is None or device_sn is None or not self._owns(device_sn):
+            return
+        self.controls.submit((device_sn, object_id), (handler, short_name, msg.payload.decode()))
+
+    def on_trace_dump(self, client, userdata, msg):
+        # Payload: optional serial or short name and optional frame count, e.g. "ps1234 20"
+        device_sn, count = None, None
+        for token in msg.payload.decode(errors="replace").split():
+            if token.isdigit():
+                count = int(token)
+            else:
+                device_sn = self.devices.resolve(token.lower()) or token.upper()
+        frames = self.tracer.recent(device_sn, count)
+        member_id = self.cluster.member_id if self.cluster is not None else None
+        topic = f"{TRACE_TOPIC}/frames/{member_id}" if member_id else f"{TRACE_TOPIC}/frames"
+        self._publish("trace", topic, json.dumps({"member": member_id, "frames": [
+            {"time": timestamp, "topic": frame_topic, "payload": base64.b64encode(payload).decode()}
+            for timestamp, frame_topic, payload in frames]}))
+        logging.info(f"Dumped {len(frames)} recent frames to {topic}")
+
+    def _run_control(self, key, value):
+        handler, short_name, payload = value
+        return handler(key[0], short_name, payload)
+
+    def _raw_value(self, device_sn, field):
+        # Raw value of a heartbeat field as last reported by the device, or None before its first heartbeat
+        record = self.devices.get(device_sn)
+        raw = record.raw() if record is not None else None
+        return raw[HEARTBEAT_CODEC.index[field]] if raw is not None else None
+
+    def _reported(self, device_sn, field, value):
+        # True when the device's last heartbeat already reports this value for the field
+        if self._raw_value(device_sn, field) != value:
+            return False
+        self.tracer.trace("controls", device_sn, "%s already %s on %s, skipping.", field, value, device_sn)
+        return True
+
+    def _command_reported(self, device_sn, state):
+        # True when the device's last heartbeat already shows the commanded (state key, raw value)
+        key, raw = state
+        return self._raw_value(device_sn, CONTROL_REPORTED[key][0]) == raw
 
     def on_message(self, client, userdata, msg):
+        # Runs on the paho network thread: only queue the raw frame, keyed by the serial in the topic.
+        # Frames from products without a decoder are dropped here by that serial, before any parsing
+        if not msg.payload:
+            return logging.info("Empty payload received.")
+        self.metrics["received"] += 1
+        parts = msg.topic.split("/")
+        cluster = self.cluster
+        # Frames forwarded by another member are handled here even if ownership has moved on since,
+        # so members with briefly different member lists cannot pass a frame back and forth
+        forwarded = cluster is not None and len(parts) == 5 and msg.topic.startswith(cluster.inbox)
+        if not forwarded:
+            if self.capture is not None:
+                self.capture.write(msg.topic, msg.payload)
+            self.tracer.record(msg.topic, msg.payload)
+        device_sn = parts[4] if forwarded else parts[3] if len(parts) == 7 else None
+        prefixes = self._topic_prefixes
+        if device_sn is None or (prefixes is not None and device_sn[:SERIAL_PREFIX_LEN] not in prefixes):
+            self.metrics["filtered"] += 1
+            return
+        if cluster is not None and not forwarded and cluster.ready:
+            owner = cluster.owner(device_sn)
+            if owner != cluster.member_id:
+                cluster.stats["forwarded"] += 1
+                self._publish("forward", f"{cluster.prefix}/{owner}/upstream/{device_sn}", msg.payload)
+                return
+        self._frame_seq += 1
+        self._decode_queue.put(device_sn, (self._frame_seq, time.monotonic(), msg.payload))
+
+    def loop_decode(self):
+        while True:
+            self.decode_step(*self._decode_queue.get())
+
+    def loop_publish(self):
+        while True:
+            pending = self.publish_step(*self._publish_queue.get())
+            if pending is not None:
+                self.scheduler.spawn(pending, "frame publisher")
+
+    def decode_step(self, key, item):
+        seq, received, payload = item
+        started = time.monotonic()
         try:
-            if not msg.payload:
-                return logging.info("Empty payload received.")
-            message = HeaderMessage()
-            message.ParseFromString(msg.payload)
-            for header in message.header:
-                if not header.device_sn.startswith("HW51") or header.cmd_id != 1:
-                    continue
-                heartbeat = InverterHeartbeat()
-                heartbeat.ParseFromString(header.pdata)
-                if self.heartbeat_logging:
-                    logging.info(f"[{header.device_sn}] Decoded heartbeat: {heartbeat}")
-                self.heartbeats[header.device_sn] = heartbeat
-                self.last_seen[header.device_sn] = time.time()
-                if not self._is_online(header.device_sn):
-                    self.device_online[header.device_sn] = True
-                    self._publish_availability(header.device_sn, True)
-                self.publish_heartbeat(header.device_sn, heartbeat)
+            for device_sn, name, decoded in self.decode_frame(payload):
+                self._publish_queue.put((device_sn, name), (seq, received, decoded))
         except DecodeError as e:
+            self._count_decode_error(e)
             logging.info(f"Decode error: {e}")
-
-    def republish_discovery(self):
-        logging.info("Republishing MQTT discovery for all known EcoFlow devices...")
-        for sn, hb in self.heartbeats.items():
-            self.publish_heartbeat(sn, hb, publish_state=self._is_online(sn))
-        
-    def check_device_offline(self):
+        except Exception as e:
+            self._count_decode_error(e)
+            logging.exception("Unexpected error while decoding frame")
+        self._record_latency("decode", time.monotonic() - started)
+
+    def publish_step(self, key, item):
+        # key: (device_sn, frame decoder name); item: (seq, received, raw values or message)
+        seq, received, decoded = item
+        # With several decode workers an older frame can finish after a newer one
+        if seq < self._published_seq.get(key, 0):
+            return
+        self._published_seq[key] = seq
+        device_sn, name = key
+        started = time.monotonic()
+        result = None
+        try:
+            result = self._frame_publishers[name](device_sn, decoded)
+        except Exception:
+            logging.exception(f"Unexpected error while publishing {name} for {device_sn}")
+        now = time.monotonic()
+        self._record_latency("publish", now - started)
+        self._record_latency("total", now - received)
+        # The awaitable of a coroutine publisher, for the runtime to await
+        return result if inspect.isawaitable(result) else None
+
+    def decode_frame(self, payload):
+        # (device_sn, decoder name, decoded) for every coalesced FRAME_DECODERS header; the others
+        # and command acks are handled on the way
+        frames, inline = self.parse_frame(payload)
+        for pending in self.handle_inline(inline):
+            self.scheduler.spawn(pending, "inline frame handler")
+        return frames
+
+    def handle_inline(self, inline):
+        # Awaitables returned by coroutine handlers, in frame order, for the runtime to await
+        pending = []
+        for name, device_sn, decoded, header in inline:
+            try:
+                result = self._frame_publishers[name](device_sn, decoded, header)
+            except Exception:
+                logging.exception(f"Unexpected error while handling {name} for {device_sn}")
+                continue
+            if inspect.isawaitable(result):
+                pending.append(result)
+        return pending
+
+    def parse_frame(self, payload):
+        # Protobuf work only (safe to run in an executor): coalesced frames, and (name, device_sn,
+        # decoded, header) for frames handled inline, command ack candidates included
+        started = time.perf_counter()
+        message = HeaderMessage()
+        message.ParseFromString(payload)
+        self.parse_latency["HeaderMessage"].observe(time.perf_counter() - started)
+        frames, inline = [], []
+        for header in message.header:
+            device_sn, cmd_func, cmd_id = header.device_sn, header.cmd_func, header.cmd_id
+            decoder = (FRAME_DECODERS.get((device_sn[:SERIAL_PREFIX_LEN], cmd_func, cmd_id))
+                       or FRAME_DECODERS.get((header.product_id, cmd_func, cmd_id)))
+            if decoder is None:
+                if cmd_func == COMMAND_HEADER["cmd_func"]:
+                    inline.append(("ack", device_sn, None, header))
+                else:
+                    self._count_unknown(device_sn, cmd_func, cmd_id)
+                continue
+            name, message_type, codec, _, coalesce = decoder
+            started = time.perf_counter()
+            decoded = message_type.FromString(header.pdata)
+            self.parse_latency[name].observe(time.perf_counter() - started)
+            self.tracer.trace("frames", device_sn, "[%s] Decoded %s: %s", device_sn, name, decoded)
+            if codec is not None:
+                decoded = codec.raw(decoded)
+            if coalesce:
+                frames.append((device_sn, name, decoded))
+            else:
+                inline.append((name, device_sn, decoded, header))
+        return frames, inline
+
+    def _acknowledge(self, device_sn, decoded, header):
+        state = self.pending_commands.acknowledge(device_sn, header.seq, header.cmd_id)
+        if state is None:
+            if self.pending_commands.late(device_sn, header.seq, header.cmd_id):
+                return self.tracer.trace("controls", device_sn, "Late ack %s for command %s from %s", header.seq, header.cmd_id, device_sn)
+            # Same cmd_func as our commands, but no decoder and no pending command matched it
+            return self._count_unknown(header.device_sn, header.cmd_func, header.cmd_id)
+        self.tracer.trace("controls", device_sn, "%s command %s acknowledged by %s", state[0], header.seq, device_sn)
+        self._publish_confirmed(header.device_sn, *state)
+
+    def handle_event_report(self, device_sn, report, header):
+        # Not registered in FRAME_DECODERS yet (see there). Unacked reports are resent by the device;
+        # repeats of an event_seq are dropped by the buffer
+        self.events.add(device_sn, report.event_seq,
+                        ((item.timestamp, item.sys_ms, item.event_no, tuple(item.event_detail)) for item in report.event_item))
+
+    def _publish_events(self, device_sn, records):
+        # One HA event per batch; the records are in event order in its `records` attribute
+        payload = {"event_type": "record", "count": len(records), "records": [
+            {"timestamp": timestamp, "sys_ms": sys_ms, "event_no": event_no, "event_detail": [round(v, 3) for v in detail]}
+            for timestamp, sys_ms, event_no, detail in records]}
+        self._publish("events", f"homeassistant/event/ecoflow_{self._short_name(device_sn)}_events/state", json.dumps(payload))
+
+    def _publish_confirmed(self, device_sn, key, raw):
+        # Show an acked value right away instead of waiting for the next heartbeat to report it,
+        # converted the way that heartbeat will; JSON state documents pick it up with the heartbeat
+        if self.state_mode != "topics":
+            return
+        value = CONTROL_REPORTED[key][1](raw)
+        component, object_id = CONTROL_STATES[key]
+        topic = f"homeassistant/{component}/ecoflow_{self._short_name(device_sn)}_{object_id}/state"
+        cache = self._state_cache.get(device_sn)
+        if cache is not None:
+            cache[topic] = (value, time.monotonic())
+        self._publish("control", topic, str(value))
+
+    def _log_command_stats(self):
+        tracker = self.pending_commands
+        latencies = []
+        for key, (count, total, peak) in list(tracker.latency.items()):
+            latencies.append(f"{key} avg {1000 * total / count:.0f} ms / max {1000 * peak:.0f} ms")
+        tracker.latency.clear()
+        stats = tracker.stats
+        if latencies or stats["confirmed"] or stats["late"] or stats["retried"] or stats["failed"]:
+            logging.info(f"Commands: {stats['acked']} acked, {stats['confirmed']} confirmed by heartbeat, "
+                         f"{stats['late']} late acks, {stats['retried']} retried, {stats['failed']} failed"
+                         + (f"; round trip {', '.join(latencies)}" if latencies else ""))
+
+    def _log_event_stats(self):
+        stats = self.events.stats
+        if stats["reports"] or stats["duplicates"]:
+            logging.info(f"Events: {stats['reports']} reports ({stats['duplicates']} duplicates), "
+                         f"{stats['records']} records, {stats['published']} published, {stats['dropped']} dropped")
+
+    def _log_trace_stats(self):
+        tracer = self.tracer
+        if tracer.categories:
+            logging.info("Trace lines: " + ", ".join(
+                f"{category} {counts['emitted']} logged / {counts['sampled']} sampled out / {counts['limited']} rate limited"
+                for category, counts in tracer.stats.items() if category in tracer.categories))
+
+    def _flush_capture(self):
+        if self.capture is not None:
+            self.capture.flush()
+            logging.info(f"Captured {self.capture.records} upstream frames to {self.capture.path}")
+
+    def _count_decode_error(self, error):
+        errors = self.metrics["decode_errors"]
+        name = type(error).__name__
+        errors[name] = errors.get(name, 0) + 1
+
+    def query_history(self, path, params):
+        # /history lists devices and fields; /history/<serial or short name>/<field>?seconds=&last=&points=
+        history = self.history
+        if history is None:
+            return 404, {"error": "history is disabled (history_size 0)"}
+        if not path:
+            return 200, {"devices": history.devices(), "fields": list(history.keys), "capacity": history.capacity,
+                         "bytes_per_device": history.bytes_per_device, "bytes": history.bytes_per_device * len(history)}
+        if len(path) != 2:
+            return 404, {"error": "expected /history/<device>/<field>"}
+        device_sn = self.devices.resolve(path[0]) or path[0]
+        number = {key: float(values[-1]) if key == "seconds" else int(values[-1])
+                  for key, values in params.items() if key in ("seconds", "last", "points")}
+        result = history.query(device_sn, path[1], **number)
+        if result is None:
+            return 404, {"error": f"no history for {path[0]} {path[1]}"}
+        return 200, result
+
+    def _count_unknown(self, device_sn, cmd_func, cmd_id):
+        counts = self.metrics["unknown_frames"]
+        key = (device_sn[:SERIAL_PREFIX_LEN], cmd_func, cmd_id)
+        if key not in counts:
+            logging.info(f"No decoder for {key[0]} frames with cmd_func {cmd_func}, cmd_id {cmd_id}; ignoring them")
+        counts[key] = counts.get(key, 0) + 1
+
+    def render_metrics(self):
+        # Prometheus text exposition of the decode/publish hot path
+        metrics, lines = self.metrics, []
+
+        def metric(name, kind, help_text, samples):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            lines.extend(samples)
+
+        metric("ecoflow_messages_received_total", "counter", "Upstream MQTT messages received.",
+               [f"ecoflow_messages_received_total {metrics['received']}"])
+        metric("ecoflow_frames_filtered_total", "counter", "Frames dropped by topic before parsing.",
+               [f"ecoflow_frames_filtered_total {metrics['filtered']}"])
+        metric("ecoflow_frames_unknown_total", "counter", "Headers without a frame decoder, by serial prefix, cmd_func and cmd_id.",
+               [f'ecoflow_frames_unknown_total{{prefix="{prefix}",cmd_func="{cmd_func}",cmd_id="{cmd_id}"}} {count}'
+                for (prefix, cmd_func, cmd_id), count in list(metrics["unknown_frames"].items())])
+        metric("ecoflow_decode_errors_total", "counter", "Upstream frames that failed to decode, by error type.",
+               [f'ecoflow_decode_errors_total{{type="{name}"}} {count}' for name, count in list(metrics["decode_errors"].items())])
+        samples = []
+        for name, histogram in self.parse_latency.items():
+            samples += histogram.render("ecoflow_parse_seconds", f'message="{name}",')
+        metric("ecoflow_parse_seconds", "histogram", "ParseFromString latency by protobuf message.", samples)
+        metric("ecoflow_publishes_per_heartbeat", "histogram", "MQTT state publishes per decoded heartbeat.",
+               self.publishes_per_heartbeat.render("ecoflow_publishes_per_heartbeat"))
+        metric("ecoflow_states_total", "counter", "State updates published or suppressed as unchanged.",
+               [f'ecoflow_states_total{{result="{result}"}} {count}' for result, count in self.state_stats.items()])
+        metric("ecoflow_pipeline_queue_depth", "gauge", "Frames waiting in each pipeline stage.",
+               [f'ecoflow_pipeline_queue_depth{{stage="decode"}} {len(self._decode_queue)}',
+                f'ecoflow_pipeline_queue_depth{{stage="publish"}} {len(self._publish_queue)}'])
+        metric("ecoflow_mqtt_outbound_queue", "gauge", "Messages queued in the MQTT client for sending.",
+               [f"ecoflow_mqtt_outbound_queue {len(getattr(self.client, '_out_packet', ()))}"])
         now = time.time()
-        for sn, last in list(self.last_seen.items()):
-            is_now_offline = (now - last) > self.offline_timeout
-            was_online = self._is_online(sn)
-
-            if is_now_offline and was_online:
-                logging.info(f"{sn} is offline. Marking unavailable.")
-                self.device_online[sn] = False
-                self._publish_availability(sn, False)
-
-                short_name = self._short_name(sn)
-                online_state_topic = f"homeassistant/binary_sensor/ecoflow_{short_name}_online/state"
-                self.client.publish(online_state_topic, "OFF", retain=True)
+        metric("ecoflow_device_last_seen_age_seconds", "gauge", "Seconds since the last heartbeat from each device.",
+               [f'ecoflow_device_last_seen_age_seconds{{device_sn="{record.device_sn}"}} {now - record.last_seen:.1f}'
+                for record in self.devices.snapshot().values() if record.state is not None])
+        if self.history is not None:
+            metric("ecoflow_history_bytes", "gauge", "Memory allocated to history ring buffers.",
+                   [f"ecoflow_history_bytes {self.history.bytes_per_device * len(self.history)}"])
+        metric("ecoflow_events_total", "counter", "Device event reports and records, by outcome.",
+               [f'ecoflow_events_total{{result="{result}"}} {count}' for result, count in self.events.stats.items()])
+        if self.cluster is not None:
+            cluster = self.cluster
+            metric("ecoflow_cluster_members", "gauge", "Live members of the cluster group.",
+                   [f"ecoflow_cluster_members {len(cluster.members)}"])
+            metric("ecoflow_cluster_devices_owned", "gauge", "Devices owned by this member.",
+                   [f"ecoflow_cluster_devices_owned {len(self._owned)}"])
+            metric("ecoflow_frames_forwarded_total", "counter", "Upstream frames forwarded to the owning member.",
+                   [f"ecoflow_frames_forwarded_total {cluster.stats['forwarded']}"])
+            metric("ecoflow_cluster_rebalances_total", "counter", "Member list changes.",
+                   [f"ecoflow_cluster_rebalances_total {cluster.stats['rebalances']}"])
+        metric("ecoflow_trace_lines_total", "counter", "Trace log lines by category and outcome.",
+               [f'ecoflow_trace_lines_total{{category="{category}",result="{result}"}} {count}'
+                for category, counts in self.tracer.stats.items() for result, count in counts.items()])
+        metric("ecoflow_commands_sent_total", "counter", "Control commands sent, including retries, by command type.",
+               [f'ecoflow_commands_sent_total{{command="{name}"}} {count}' for name, count in list(metrics["commands_sent"].items())])
+        metric("ecoflow_command_results_total", "counter", "Control command outcomes.",
+               [f'ecoflow_command_results_total{{result="{result}"}} {count}' for result, count in self.pending_commands.stats.items()])
+        return "\n".join(lines) + "\n"
+
+    def handle_heartbeat(self, device_sn, raw):
+        # raw: InverterHeartbeat values aligned with HEARTBEAT_CODEC.keys
+        now = time.time()
+        is_new = self.devices.update(device_sn, raw, now)
+        if self.cluster is not None and device_sn not in self._owned and self._owns(device_sn):
+            self._claim_device(device_sn)
+        self.energy.add(device_sn, raw, now)
+        if self.history is not None:
+            self.history.add(device_sn, now, raw)
+        if is_new:
+            self._track_device(device_sn)
+        if not self._owns(device_sn):
+            # Another cluster member publishes this device
+            return
+        if is_new:
+            self._publish_discovery(device_sn)
+        if is_new or device_sn in self._unannounced or not self._is_online(device_sn):
+            self._unannounced.discard(device_sn)
+            self._set_online(device_sn, True)
+            self.scheduler.schedule(("offline", device_sn), self.offline_timeout, self.check_device_offline, device_sn)
+        if self.site is not None:
+            self.site.update(device_sn, raw)
+        self.publish_heartbeat(device_sn, raw)
+
+    def energy_tick(self):
+        self.scheduler.schedule("energy", self.energy_interval, self.energy_tick)
+        now = time.monotonic()
+        for device_sn in self.energy.devices():
+            if self.cluster is not None and (device_sn not in self._owned or self._energy_seeding.get(device_sn, 0) > now):
+                continue
+            totals = self.energy.totals(device_sn)
+            rounded = tuple(round(total, 1) for total in totals)
+            if self._energy_published.get(device_sn) == rounded:
+                continue
+            self._energy_published[device_sn] = rounded
+            base_topic = f"homeassistant/sensor/ecoflow_{self._short_name(device_sn)}"
+            for key, value in zip(self.energy.keys, rounded):
+                self._publish("energy", f"{base_topic}/{key}/state", str(value))
+
+    def site_tick(self):
+        self.scheduler.schedule("site", self.site_interval, self.site_tick)
+        partials, cluster = [self.site.partial()], self.cluster
+        if cluster is not None:
+            # One member publishes the site device; the others send it their partial sums
+            if not cluster.ready:
+                return
+            if cluster.owner(SITE_ID) != cluster.member_id:
+                self._site_published = None
+                self._publish("forward", f"{cluster.prefix}/site/{cluster.member_id}", json.dumps(partials[0]))
+                return
+            members = cluster.members
+            partials += [partial for member_id, partial in list(self._site_partials.items())
+                         if member_id in members and member_id != cluster.member_id]
+        values = self.site.values(partials)
+        if values == self._site_published:
+            return
+        if self._site_published is None:
+            self._publish_configs(self._site_configs())
+        self._site_published = values
+        self._publish("telemetry", f"homeassistant/sensor/{SITE_ID}/state", json.dumps(values))
+
+    def _track_device(self, device_sn):
+        # Spread outbound heartbeats over the interval instead of bursting them all at once
+        offset = zlib.crc32(device_sn.encode()) % 1000 / 1000 * self.heartbeat_interval
+        self.scheduler.schedule(("heartbeat", device_sn), offset, self.send_inverter_heartbeat, device_sn)
+
+    def _record_latency(self, stage, seconds):
+        # [count, total, max] since the last stats log
+        latency = self.pipeline_latency[stage]
+        latency[0] += 1
+        latency[1] += seconds
+        if seconds > latency[2]:
+            latency[2] = seconds
+
+    def _log_pipeline_stats(self):
+        decode, publish = self._decode_queue, self._publish_queue
+        latencies = []
+        for stage, latency in self.pipeline_latency.items():
+            count, total, peak = latency
+            if count:
+                latencies.append(f"{stage} avg {1000 * total / count:.1f} ms / max {1000 * peak:.1f} ms")
+            self.pipeline_latency[stage] = [0, 0.0, 0.0]
+        if latencies:
+            logging.info(f"Pipeline: decode queue {len(decode)} (max {decode.stats['max_depth']}), "
+                         f"publish queue {len(publish)} (max {publish.stats['max_depth']}), "
+                         f"{publish.stats['coalesced']} coalesced, "
+                         f"{decode.stats['dropped'] + publish.stats['dropped']} dropped; {', '.join(latencies)}")
+
+    def republish_discovery(self, force=False):
+        # Only changed configs are sent unless a resync is forced (HA restart, broker reconnect)
+        count, devices = 0, self.devices.snapshot()
+        if force:
+            self._energy_published.clear()
+            # The next site_tick publishes the site device again
+            self._site_published = None
+        for sn, record in devices.items():
+            raw = record.raw()
+            if raw is None or not self._owns(sn):
+                continue
+            count += self._publish_discovery(sn, force=force)
+            if force:
+                self._set_online(sn, record.online)
+                self.publish_heartbeat(sn, raw, publish_state=record.online, force=True)
+        if count:
+            logging.info(f"Republished {count} MQTT discovery configs for {len(devices)} EcoFlow devices")
+
+    def check_device_offline(self, device_sn):
+        # Fires at the device's offline deadline; heartbeats since it was armed push it back
+        last_seen = self.devices.get(device_sn).last_seen
+        if last_seen is None:
+            return
+        remaining = last_seen + self.offline_timeout - time.time()
+        if remaining > 0:
+            self.scheduler.schedule(("offline", device_sn), remaining, self.check_device_offline, device_sn)
+        elif self._is_online(device_sn) and self._owns(device_sn):
+            logging.info(f"{device_sn} is offline. Marking unavailable.")
+            self._set_online(device_sn, False)
 
     def _short_name(self, device_sn: str) -> str:
-        return f"ps{device_sn[-4:].lower()}"
+        return self.devices.short_name(device_sn)
 
     def _availability_topic(self, device_sn: str) -> str:
         short_name = self._short_name(device_sn)
@@ -114,121 +2183,197 @@ class EcoflowDecoder:
 
     def _publish_availability(self, device_sn: str, online: bool):
         topic = self._availability_topic(device_sn)
-        self.client.publish(topic, "online" if online else "offline", retain=True)
+        self._publish("availability", topic, "online" if online else "offline")
+
+    def _set_online(self, device_sn: str, online: bool):
+        self.devices.record(device_sn).online = online
+        if not online and self.site is not None:
+            self.site.remove(device_sn)
+        # Forget published states so everything is refreshed when the device returns
+        self._state_cache.pop(device_sn, None)
+        self._publish_availability(device_sn, online)
+        online_state_topic = f"homeassistant/binary_sensor/ecoflow_{self._short_name(device_sn)}_online/state"
+        self._publish("availability", online_state_topic, "ON" if online else "OFF")
 
     def _is_online(self, device_sn: str) -> bool:
-        return self.device_online.get(device_sn, True)
-
-    def send_inverter_heartbeat(self):
-        for sn in self.heartbeats:
-            hb = SendMsgHart(
-                link_id=15, 
-                src=32, 
-                dest=53, 
-                d_src=1, 
-                d_dest=1, 
-                enc_type=0, 
-                check_type=0, 
-                cmd_func=32, 
-                cmd_id=10, 
-                data_len=2, 
-                need_ack=1, 
-                is_ack=0, 
-                ack_type=0, 
-                seq=int(time.time()))
-            self.client.publish(f"/sys/75/{sn}/thing/property/cmd", hb.SerializeToString())
-            if self.heartbeat_logging:         
-                logging.info(f"Sent inverter heartbeat to {sn}")
-
-    def publish_heartbeat(self, device_sn, hb, publish_state=True):
-        short_name = f"ps{device_sn[-4:].lower()}"
-        last4 = device_sn[-4:].lower()
+        record = self.devices.get(device_sn)
+        return record.online if record is not None else True
 
-        availability_topic = self._availability_topic(device_sn)
+    def send_inverter_heartbeat(self, sn):
+        self.scheduler.schedule(("heartbeat", sn), self.heartbeat_interval, self.send_inverter_heartbeat, sn)
+        if not self._owns(sn):
+            return
+        hb = SendMsgHart(
+            link_id=15, 
+            src=32, 
+            dest=53, 
+            d_src=1, 
+            d_dest=1, 
+            enc_type=0, 
+            check_type=0, 
+            cmd_func=32, 
+            cmd_id=10, 
+            data_len=2, 
+            need_ack=1, 
+            is_ack=0, 
+            ack_type=0, 
+            seq=self.commands.next_seq(sn))
+        self._publish("command", f"/sys/75/{sn}/thing/property/cmd", hb.SerializeToString())
+        self.tracer.trace("heartbeats", sn, "Sent inverter heartbeat to %s", sn)
+
+    def publish_heartbeat(self, device_sn, raw, publish_state=True, force=False):
+        # raw: unscaled heartbeat values aligned with HEARTBEAT_CODEC.keys.
+        # Discovery configs are handled by _publish_discovery; only states go out here
+        if not (publish_state and self._is_online(device_sn)):
+            return
 
-        # Human-readable names for fields
-        field_names = {
-            "inv_error_code": "Inverter Error Code",
-            "inv_warning_code": "Inverter Warning Code",
-            "pv1_error_code": "PV1 Error Code",
-            "pv1_warning_code": "PV1 Warning Code",
-            "pv2_error_code": "PV2 Error Code",
-            "pv2_warning_code": "PV2 Warning Code",
-            "bat_error_code": "Battery Error Code",
-            "bat_warning_code": "Battery Warning Code",
-            "llc_error_code": "LLC Error Code",
-            "llc_warning_code": "LLC Warning Code",
-            "wireless_error_code": "Wireless Error Code",
-            "wireless_warning_code": "Wireless Warning Code",
-            "pv1_status": "PV1 Status",
-            "pv2_status": "PV2 Status",
-            "bat_status": "Battery Status",
-            "llc_status": "LLC Status",
-            "inv_status": "Inverter Status",
-            "pv1_input_volt": "PV1 Input Voltage",
-            "pv1_op_volt": "PV1 Operating Voltage",
-            "pv1_input_cur": "PV1 Input Current",
-            "pv1_input_watts": "PV1 Input Power",
-            "pv1_temp": "PV1 Temperature",
-            "pv2_input_volt": "PV2 Input Voltage",
-            "pv2_op_volt": "PV2 Operating Voltage",
-            "pv2_input_cur": "PV2 Input Current",
-            "pv2_input_watts": "PV2 Input Power",
-            "pv2_temp": "PV2 Temperature",
-            "bat_input_volt": "Battery Input Voltage",
-            "bat_op_volt": "Battery Operating Voltage",
-            "bat_input_cur": "Battery Input Current",
-            "bat_input_watts": "Battery Input Power",
-            "bat_temp": "Battery Temperature",
-            "bat_soc": "Battery State of Charge",
-            "llc_input_volt": "LLC Input Voltage",
-            "llc_op_volt": "LLC Operating Voltage",
-            "llc_temp": "LLC Temperature",
-            "inv_input_volt": "Inverter Input Voltage",
-            "inv_op_volt": "Inverter Operating Voltage",
-            "inv_output_cur": "Inverter Output Current",
-            "inv_output_watts": "Inverter Output Power",
-            "inv_temp": "Inverter Temperature",
-            "inv_freq": "Inverter Frequency",
-            "inv_dc_cur": "Inverter DC Current",
-            "bp_type": "Battery Pack Type",
-            "inv_relay_status": "Inverter Relay Status",
-            "pv1_relay_status": "PV1 Relay Status",
-            "pv2_relay_status": "PV2 Relay Status",
-            "install_country": "Installation Country",
-            "install_town": "Installation Town",
-            "permanent_watts": "Permanent Power",
-            "dynamic_watts": "Dynamic Power",
-            "supply_priority": "Supply Priority",
-            "lower_limit": "Discharge Limit",
-            "upper_limit": "Charge Limit",
-            "inv_on_off": "Inverter On/Off",
-            "inv_brightness": "Inverter Brightness",
-            "heartbeat_frequency": "Heartbeat Frequency",
-            "rated_power": "Rated Power",
-            "battery_charge_remain": "Battery Charge Remaining",
-            "battery_discharge_remain": "Battery Discharge Remaining"
-        }
+        values = self.codec.decode_raw(self._codec_raw(raw))
+        values.append(int(raw[RAW_PERMANENT_WATTS] / 10))
+        values.append("Prioritize power supply" if raw[RAW_SUPPLY_PRIORITY] == 0 else "Prioritize power storage")
+
+        now = time.monotonic()
+        cache = self._state_cache.setdefault(device_sn, {})
+        deadbands = self._state_deadbands
+        if self.state_mode == "json":
+            # One document per device; every entity picks its field with a value_template
+            if force or any(self._state_changed(cache, key, value, deadband, now)
+                            for key, value, deadband in zip(self._state_keys, values, deadbands)):
+                for key, value in zip(self._state_keys, values):
+                    cache[key] = (value, now)
+                self._publish("telemetry", self._json_state_topic(device_sn), json.dumps(dict(zip(self._state_keys, values))))
+                self.state_stats["published"] += 1
+                self.publishes_per_heartbeat.observe(1)
+            else:
+                self.state_stats["suppressed"] += 1
+                self.publishes_per_heartbeat.observe(0)
+            return
+
+        published = 0
+        for i, topic, cls in self._state_topics(device_sn):
+            value = values[i]
+            if force or self._state_changed(cache, topic, value, deadbands[i], now):
+                cache[topic] = (value, now)
+                self._publish(cls, topic, str(value))
+                published += 1
+            else:
+                self.state_stats["suppressed"] += 1
+        self.state_stats["published"] += published
+        self.publishes_per_heartbeat.observe(published)
+
+    def _state_changed(self, cache, key, value, deadband, now):
+        # Unchanged (or within-deadband) states are held back until older than state_max_age
+        last = cache.get(key)
+        if last is None or now - last[1] >= self.state_max_age:
+            return True
+        if value == last[0] or (deadband and abs(value - last[0]) <= deadband):
+            return False
+        return True
+
+    def _state_topics(self, device_sn):
+        # (value index, state topic, publish class) for per-topic mode, built once per device
+        topics = self._state_topic_cache.get(device_sn)
+        if topics is None:
+            short_name = self._short_name(device_sn)
+            topics = [(i, f"homeassistant/sensor/ecoflow_{short_name}/{key}/state", "telemetry")
+                      for i, key in enumerate(self.codec.keys) if key in self.sensor_fields]
+            topics += [(self._state_keys.index(key), f"homeassistant/{component}/ecoflow_{short_name}_{object_id}/state", "control")
+                       for key, (component, object_id) in CONTROL_STATES.items()]
+            self._state_topic_cache[device_sn] = topics
+        return topics
+
+    def _json_state_topic(self, device_sn):
+        return f"homeassistant/sensor/ecoflow_{self._short_name(device_sn)}/state"
+
+    def _log_state_stats(self):
+        published, suppressed = self.state_stats["published"], self.state_stats["suppressed"]
+        total = published + suppressed
+        if total:
+            logging.info(f"State publishes: {published} sent, {suppressed} suppressed ({100.0 * suppressed / total:.1f}%)")
+
+    def _publish_discovery(self, device_sn, force=False):
+        return self._publish_configs(self._discovery_configs(device_sn), force)
+
+    def _publish_configs(self, configs, force=False):
+        # Publish retained discovery configs, skipping topics whose payload is unchanged
+        count = 0
+        for topic, payload in configs.items():
+            if not force and self._discovery_published.get(topic) == payload:
+                continue
+            self._publish("discovery", topic, payload)
+            self._discovery_published[topic] = payload
+            count += 1
+        return count
+
+    def _discovery_configs(self, device_sn):
+        key = (device_sn, DISCOVERY_SCHEMA_VERSION, self.state_mode)
+        configs = self._discovery_cache.get(key)
+        if configs is None:
+            configs = self._build_discovery(device_sn)
+            self._discovery_cache[key] = configs
+        return configs
+
+    def _site_configs(self):
+        # Synthetic "EcoFlow Site" device reading the site state document
+        configs = self._discovery_cache.get(SITE_ID)
+        if configs is not None:
+            return configs
+        base_topic = f"homeassistant/sensor/{SITE_ID}"
+        device_info = {"identifiers": [SITE_ID], "manufacturer": "EcoFlow", "model": "Site", "name": "EcoFlow Site"}
+        sensors = [(key, name, "W") for key, name, _ in SITE_SENSORS]
+        sensors += [("average_soc", "Average Battery SOC", "%"), ("min_soc", "Minimum Battery SOC", "%"),
+                    ("devices_online", "Devices Online", None)]
+        configs = {}
+        for key, name, unit in sensors:
+            config_payload = {
+                "name": name,
+                "state_topic": f"{base_topic}/state",
+                "value_template": f"{{{{ value_json.{key} }}}}",
+                "unique_id": f"{SITE_ID}_{key}",
+                "state_class": "measurement",
+                "device": device_info
+            }
+            if unit:
+                config_payload["unit_of_measurement"] = unit
+                config_payload["device_class"] = DEVICE_CLASSES[unit]
+            configs[f"{base_topic}/{key}/config"] = config_payload
+        configs = self._discovery_cache[SITE_ID] = {topic: json.dumps(payload) if payload else payload
+                                                    for topic, payload in configs.items()}
+        return configs
+
+    def _build_discovery(self, device_sn):
+        # Build every discovery config for a device once, already serialized
+        short_name = self._short_name(device_sn)
+        # Last 4 serial characters, or the longer suffix the registry picked on a collision
+        last4 = short_name[2:]
 
+        availability_topic = self._availability_topic(device_sn)
         base_topic = f"homeassistant/sensor/ecoflow_{short_name}"
         online_topic = f"homeassistant/binary_sensor/ecoflow_{short_name}_online"
-
-        mode_state_topic = f"homeassistant/select/ecoflow_{short_name}_supply_mode/state"
-        mode_value = "Prioritize power supply" if hb.supply_priority == 0 else "Prioritize power storage"
-
-        # Convert raw brightness (0–1023) to percentage for HA
-        brightness_percent = int((hb.inv_brightness / 1023.0) * 100) if hasattr(hb, "inv_brightness") else 0
+        availability = {
+            "availability_topic": availability_topic,
+            "payload_available": "online",
+            "payload_not_available": "offline",
+        }
 
         # Device info
         device_info = {
             "identifiers": [f"ecoflow_{short_name}"],
             "manufacturer": "EcoFlow",
             "model": "PowerStream",
-            "name": f"EcoFlow PS{device_sn[-4:]}"
+            "name": f"EcoFlow PS{device_sn[-len(last4):]}"
         }
 
+        json_topic = self._json_state_topic(device_sn)
+
+        def state(topic, key):
+            if self.state_mode == "json":
+                return {"state_topic": json_topic, "value_template": f"{{{{ value_json.{key} }}}}"}
+            return {"state_topic": topic}
+
+        configs = {}
+
         # Online binary_sensor (represents availability)
-        config_online = {
+        configs[f"{online_topic}/config"] = {
             "name": "Online",
             "state_topic": f"{online_topic}/state",
             "unique_id": f"ecoflow_{last4}_online",
@@ -237,475 +2382,301 @@ class EcoflowDecoder:
             "payload_off": "OFF",
             "device": device_info
         }
-        self.client.publish(f"{online_topic}/config", json.dumps(config_online), retain=True)
-
-        # Keep it consistent with our derived online state
-        online_now = self._is_online(device_sn)
-        self.client.publish(f"{online_topic}/state", "ON" if online_now else "OFF", retain=True)
-
-        # ---- Publish availability topic (retained) ----
-        self._publish_availability(device_sn, online_now)
-
-        # ---- Field definitions ----
-        fields = {
-            "inv_error_code": (hb.inv_error_code, None),
-            "inv_warning_code": (hb.inv_warning_code, None),
-            "pv1_error_code": (hb.pv1_error_code, None),
-            "pv1_warning_code": (hb.pv1_warning_code, None),
-            "pv2_error_code": (hb.pv2_error_code, None),
-            "pv2_warning_code": (hb.pv2_warning_code, None),
-            "bat_error_code": (hb.bat_error_code, None),
-            "bat_warning_code": (hb.bat_warning_code, None),
-            "llc_error_code": (hb.llc_error_code, None),
-            "llc_warning_code": (hb.llc_warning_code, None),
-            "wireless_error_code": (hb.wireless_error_code, None),
-            "wireless_warning_code": (hb.wireless_warning_code, None),
-            "pv1_status": (hb.pv1_status, None),
-            "pv2_status": (hb.pv2_status, None),
-            "bat_status": (hb.bat_status, None),
-            "llc_status": (hb.llc_status, None),
-            "inv_status": (hb.inv_status, None),
-            "pv1_input_volt": (hb.pv1_input_volt / 10.0, "V"),
-            "pv1_op_volt": (hb.pv1_op_volt / 100.0, "V"),
-            "pv1_input_cur": (hb.pv1_input_cur / 10.0, "A"),
-            "pv1_input_watts": (hb.pv1_input_watts / 10.0, "W"),
-            "pv1_temp": (hb.pv1_temp / 10.0, "°C"),
-            "pv2_input_volt": (hb.pv2_input_volt / 10.0, "V"),
-            "pv2_op_volt": (hb.pv2_op_volt / 100.0, "V"),
-            "pv2_input_cur": (hb.pv2_input_cur / 10.0, "A"),
-            "pv2_input_watts": (hb.pv2_input_watts / 10.0, "W"),
-            "pv2_temp": (hb.pv2_temp / 10.0, "°C"),
-            "bat_input_volt": (hb.bat_input_volt / 10.0, "V"),
-            "bat_op_volt": (hb.bat_op_volt / 10.0, "V"),
-            "bat_input_cur": (hb.bat_input_cur / 10.0, "A"),
-            "bat_input_watts": (hb.bat_input_watts / 10.0, "W"),
-            "bat_temp": (hb.bat_temp / 10.0, "°C"),
-            "bat_soc": (hb.bat_soc, "%"),
-            "llc_input_volt": (hb.llc_input_volt / 10.0, "V"),
-            "llc_op_volt": (hb.llc_op_volt / 100.0, "V"),
-            "llc_temp": (hb.llc_temp / 10.0, "°C"),
-            "inv_input_volt": (hb.inv_input_volt / 100.0, "V"),
-            "inv_op_volt": (hb.inv_op_volt / 10.0, "V"),
-            "inv_output_cur": (hb.inv_output_cur / 1000.0, "A"),
-            "inv_output_watts": (hb.inv_output_watts / 10.0, "W"),
-            "inv_temp": (hb.inv_temp / 10.0, "°C"),
-            "inv_freq": (hb.inv_freq / 10.0, "Hz"),
-            "inv_dc_cur": (hb.inv_dc_cur / 1000.0, "A"),
-            "bp_type": (hb.bp_type, None),
-            "inv_relay_status": (hb.inv_relay_status, None),
-            "pv1_relay_status": (hb.pv1_relay_status, None),
-            "pv2_relay_status": (hb.pv2_relay_status, None),
-            "install_country": (hb.install_country, None),
-            "install_town": (hb.install_town, None),
-            "permanent_watts": (hb.permanent_watts / 10.0, "W"),
-            "dynamic_watts": (hb.dynamic_watts / 10.0, "W"),
-            "supply_priority": (hb.supply_priority, None),
-            "lower_limit": (hb.lower_limit, "%"),
-            "upper_limit": (hb.upper_limit, "%"),
-            "inv_on_off": (hb.inv_on_off, None),
-            "inv_brightness": (brightness_percent, "%"),
-            "heartbeat_frequency": (hb.heartbeat_frequency, "s"),
-            "rated_power": (hb.rated_power / 10.0, "W"),
-            "battery_charge_remain": (hb.battery_charge_remain, "min"),
-            "battery_discharge_remain": (hb.battery_discharge_remain, "min")
-        }
 
-        device_classes = {
-            "V": "voltage",
-            "mV": "voltage",
-            "A": "current",
-            "W": "power",
-            "Wh": "energy",
-            "%": "battery",
-            "C": "temperature",
-            "Hz": "frequency",
-            "s": "duration",
-            "min": "duration"
-        }
-
-        hidden_entities = [k for k in fields.keys() if "error_code" in k or "warning_code" in k or "status" in k]
-
-        # Publish each sensor (with availability)
-        for key, (value, unit) in fields.items():
-            config_topic = f"{base_topic}/{key}/config"
-            state_topic = f"{base_topic}/{key}/state"
+        # Sensors (with availability)
+        for _, key, name, _, unit, device_class, hidden in self.codec.entries:
+            if key not in self.sensor_fields:
+                continue
             config_payload = {
-                "name": field_names.get(key, key.replace('_', ' ').title()),
-                "state_topic": state_topic,
+                "name": name,
+                **state(f"{base_topic}/{key}/state", key),
                 "unique_id": f"ecoflow_{last4}_{key}",
-                "availability_topic": availability_topic,
-                "payload_available": "online",
-                "payload_not_available": "offline",
+                **availability,
                 "device": device_info
             }
             if unit:
                 config_payload["unit_of_measurement"] = unit
-                if unit in device_classes:
-                    config_payload["device_class"] = device_classes[unit]
-            if key in hidden_entities:
+                if device_class:
+                    config_payload["device_class"] = device_class
+            if hidden and not self.show_hidden:
                 config_payload["enabled_by_default"] = False
-
-            self.client.publish(config_topic, json.dumps(config_payload), retain=True)
-
-            # Publish state when online (prevents zero spam + invalid ranges)
-            if publish_state and online_now:
-                self.client.publish(state_topic, str(value), retain=True)
+            configs[f"{base_topic}/{key}/config"] = config_payload
+
+        # Energy counters, integrated from power here instead of by HA; own topics in either state_mode
+        for key, name, _, _ in ENERGY_COUNTERS:
+            if self.energy_interval <= 0:
+                continue
+            configs[f"{base_topic}/{key}/config"] = {
+                "name": name,
+                "state_topic": f"{base_topic}/{key}/state",
+                "unique_id": f"ecoflow_{last4}_{key}",
+                "unit_of_measurement": "Wh",
+                "device_class": "energy",
+                "state_class": "total_increasing",
+                **availability,
+                "device": device_info
+            }
 
         # Controls (number/select)
 
         # Power limit number
-        limit_topic = f"homeassistant/number/ecoflow_{short_name}_power_limit/config"
-        limit_state = f"homeassistant/number/ecoflow_{short_name}_power_limit/state"
-        limit_payload = {
+        configs[f"homeassistant/number/ecoflow_{short_name}_power_limit/config"] = {
             "name": "Power Limit",
             "min": 0, "max": 800, "step": 1, "mode": "box",
-            "state_topic": limit_state,
+            **state(f"homeassistant/number/ecoflow_{short_name}_power_limit/state", "power_limit"),
             "command_topic": f"homeassistant/number/ecoflow_{short_name}_power_limit/set",
             "unique_id": f"ecoflow_{last4}_power_limit",
-            "availability_topic": availability_topic,
-            "payload_available": "online",
-            "payload_not_available": "offline",
+            **availability,
             "device": device_info
         }
-        self.client.publish(limit_topic, json.dumps(limit_payload), retain=True)
-        if publish_state and online_now:
-            self.client.publish(limit_state, str(int(hb.permanent_watts / 10)), retain=True)
 
         # Supply mode select
-        select_topic = f"homeassistant/select/ecoflow_{short_name}_supply_mode/config"
-        select_payload = {
+        configs[f"homeassistant/select/ecoflow_{short_name}_supply_mode/config"] = {
             "name": "Power Supply Mode",
             "options": ["Prioritize power supply", "Prioritize power storage"],
-            "state_topic": mode_state_topic,
+            **state(f"homeassistant/select/ecoflow_{short_name}_supply_mode/state", "supply_mode"),
             "command_topic": f"homeassistant/select/ecoflow_{short_name}_supply_mode/set",
             "unique_id": f"ecoflow_{last4}_supply_priority",
-            "availability_topic": availability_topic,
-            "payload_available": "online",
-            "payload_not_available": "offline",
+            **availability,
             "device": device_info
         }
-        self.client.publish(select_topic, json.dumps(select_payload), retain=True)
-        if publish_state and online_now:
-            self.client.publish(mode_state_topic, mode_value, retain=True)
-
-        # Battery lower limit number (0–30) - valid for zero but avoid publishing while offline
-        lower_topic = f"homeassistant/number/ecoflow_{short_name}_battery_lower_limit/config"
-        lower_state = f"homeassistant/number/ecoflow_{short_name}_battery_lower_limit/state"
-        lower_payload = {
+
+        # Battery lower limit number (0–30)
+        configs[f"homeassistant/number/ecoflow_{short_name}_battery_lower_limit/config"] = {
             "name": "Battery Discharge Limit",
             "min": 0, "max": 30, "step": 1, "mode": "box",
-            "state_topic": lower_state,
+            **state(f"homeassistant/number/ecoflow_{short_name}_battery_lower_limit/state", "lower_limit"),
             "command_topic": f"homeassistant/number/ecoflow_{short_name}_battery_lower_limit/set",
             "unique_id": f"ecoflow_{last4}_battery_lower_limit",
             "unit_of_measurement": "%",
-            "availability_topic": availability_topic,
-            "payload_available": "online",
-            "payload_not_available": "offline",
+            **availability,
             "device": device_info
         }
-        self.client.publish(lower_topic, json.dumps(lower_payload), retain=True)
-        if publish_state and online_now:
-            self.client.publish(lower_state, str(hb.lower_limit), retain=True)
-
-        # Battery upper limit number (50–100) - No longer zero when offline
-        upper_topic = f"homeassistant/number/ecoflow_{short_name}_battery_upper_limit/config"
-        upper_state = f"homeassistant/number/ecoflow_{short_name}_battery_upper_limit/state"
-        upper_payload = {
+
+        # Battery upper limit number (50–100)
+        configs[f"homeassistant/number/ecoflow_{short_name}_battery_upper_limit/config"] = {
             "name": "Battery Charge Limit",
             "min": 50, "max": 100, "step": 1, "mode": "box",
-            "state_topic": upper_state,
+            **state(f"homeassistant/number/ecoflow_{short_name}_battery_upper_limit/state", "upper_limit"),
             "command_topic": f"homeassistant/number/ecoflow_{short_name}_battery_upper_limit/set",
             "unique_id": f"ecoflow_{last4}_battery_upper_limit",
             "unit_of_measurement": "%",
-            "availability_topic": availability_topic,
-            "payload_available": "online",
-            "payload_not_available": "offline",
+            **availability,
             "device": device_info
         }
-        self.client.publish(upper_topic, json.dumps(upper_payload), retain=True)
-        if publish_state and online_now:
-            self.client.publish(upper_state, str(hb.upper_limit), retain=True)
 
         # Brightness number (0–100)
-        bright_topic = f"homeassistant/number/ecoflow_{short_name}_inverter_brightness/config"
-        bright_state = f"homeassistant/number/ecoflow_{short_name}_inverter_brightness/state"
-        bright_payload = {
+        configs[f"homeassistant/number/ecoflow_{short_name}_inverter_brightness/config"] = {
             "name": "Inverter Brightness",
             "min": 0, "max": 100, "step": 1, "mode": "box",
-            "state_topic": bright_state,
+            **state(f"homeassistant/number/ecoflow_{short_name}_inverter_brightness/state", "inv_brightness"),
             "command_topic": f"homeassistant/number/ecoflow_{short_name}_inverter_brightness/set",
             "unique_id": f"ecoflow_{last4}_inverter_brightness",
             "unit_of_measurement": "%",
-            "availability_topic": availability_topic,
-            "payload_available": "online",
-            "payload_not_available": "offline",
+            **availability,
             "device": device_info
         }
-        self.client.publish(bright_topic, json.dumps(bright_payload), retain=True)
-        if publish_state and online_now:
-            self.client.publish(bright_state, str(brightness_percent), retain=True)
-
-    def on_slider_change_raw(self, client, userdata, msg):
-        topic = msg.topic
-        payload = msg.payload.decode()
-        match = re.match(r"homeassistant/number/ecoflow_(.+)_power_limit/set", topic)
-        if not match:
-            return
 
-        short_name = match.group(1)
-        # Reconstruct full device_sn from heartbeats dict keys (find match by last 4 chars)
-        device_sn = next((sn for sn in self.heartbeats if sn.endswith(short_name[-4:].upper())), None)
-        if not device_sn or not device_sn.startswith("HW51"):
+        return {topic: json.dumps(payload) if payload else payload for topic, payload in configs.items()}
+
+    def _send_command(self, device_sn, cmd_id, pdata, state, attempt=0):
+        # state is the (control state key, raw heartbeat field value) the device reports once it applied
+        # the command.
+        # Retries stop once the device has moved to another cluster member
+        if not self._owns(device_sn):
             return
-        if self.control_logging:
-            logging.info(f"Received MQTT power limit update for {device_sn} via {short_name}: {payload}")
+        seq = self.commands.next_seq(device_sn)
+        sent = self.metrics["commands_sent"]
+        sent[state[0]] = sent.get(state[0], 0) + 1
+        self.pending_commands.track(device_sn, seq, cmd_id, pdata, state, attempt)
+        self._publish("command", f"/sys/75/{device_sn}/thing/property/cmd", self.commands.encode(device_sn, cmd_id, pdata, seq))
+
+    def on_slider_change_raw(self, device_sn, short_name, payload):
+        self.tracer.trace("controls", device_sn, "Received MQTT power limit update for %s via %s: %s", device_sn, short_name, payload)
 
         try:
             watts = int(float(payload))
             deci_watts = max(0, watts * 10)
-
-            last_value = self.last_limit_value.get(device_sn)
-            if last_value == watts:
-                if self.control_logging:
-                    logging.info(f"Power limit {watts}W unchanged for {device_sn}, skipping.")
+            if self._reported(device_sn, "permanent_watts", deci_watts):
                 return
 
-            self.last_limit_value[device_sn] = watts
-
-            val = setValue(value=deci_watts)
-            pdata_bytes = val.SerializeToString()
-
-            msg = setMessage(
-                header=setHeader(
-                    pdata=pdata_bytes,
-                    src=32,
-                    dest=53,
-                    d_src=1,
-                    d_dest=1,
-                    check_type=3,
-                    cmd_func=20,
-                    cmd_id=129,
-                    data_len=len(pdata_bytes),
-                    need_ack=1,
-                    seq=int(time.time()),
-                    version=19,
-                    payload_ver=1,
-                    **{"from": "ios"},
-                    device_sn=device_sn
-                )
-            )
-
-            topic = f"/sys/75/{device_sn}/thing/property/cmd"
-            self.client.publish(topic, msg.SerializeToString())
-            if self.control_logging:
-                logging.info(f"Sent power limit {watts}W ({deci_watts} deciwatts) to {device_sn}")
+            self._send_command(device_sn, 129, setValue(value=deci_watts).SerializeToString(), ("power_limit", deci_watts))
+            self.tracer.trace("controls", device_sn, "Sent power limit %sW (%s deciwatts) to %s", watts, deci_watts, device_sn)
         except Exception as e:
             logging.info(f"Failed to send power limit command for {device_sn}: {e}")
 
-    def on_supply_mode_change(self, client, userdata, msg):
-        topic = msg.topic
-        payload = msg.payload.decode()
-
-        match = re.match(r"homeassistant/select/ecoflow_(.+)_supply_mode/set", topic)
-        if not match:
-            return
-        short_name = match.group(1)
-
-        # Find full device_sn from short_name (e.g., ps1400)
-        device_sn = None
-        for sn in self.heartbeats.keys():
-            if sn.lower().endswith(short_name[-4:]):
-                device_sn = sn
-                break
-
-        if not device_sn or not device_sn.startswith("HW51"):
-            return
-
+    def on_supply_mode_change(self, device_sn, short_name, payload):
         value = 0 if payload == "Prioritize power supply" else 1
-        if self.control_logging:
-            logging.info(f"Received supply mode change for {short_name} ({device_sn}): {payload} -> {value}")
+        self.tracer.trace("controls", device_sn, "Received supply mode change for %s (%s): %s -> %s", short_name, device_sn, payload, value)
 
         try:
-            pack = SupplyPriorityPack(supply_priority=value)
-            pdata_bytes = pack.SerializeToString()
-
-            header = setHeader(
-                src=32,
-                dest=53,
-                d_src=1,
-                d_dest=1,
-                check_type=3,
-                cmd_func=20,
-                cmd_id=130,
-                data_len=len(pdata_bytes),
-                need_ack=1,
-                seq=int(time.time()),
-                version=19,
-                payload_ver=1,
-                **{"from": "ios"},
-                device_sn=device_sn
-            )
-            object.__setattr__(header, "pdata", pdata_bytes)
-
-            msg_out = setMessage(header=header)
-            topic = f"/sys/75/{device_sn}/thing/property/cmd"
-            self.client.publish(topic, msg_out.SerializeToString())
-            if self.control_logging:
-                logging.info(f"Sent raw SupplyPriorityPack ({value}) to {short_name} ({device_sn})")
+            if self._reported(device_sn, "supply_priority", value):
+                return
+            self._send_command(device_sn, 130, SupplyPriorityPack(supply_priority=value).SerializeToString(), ("supply_mode", value))
+            self.tracer.trace("controls", device_sn, "Sent raw SupplyPriorityPack (%s) to %s (%s)", value, short_name, device_sn)
 
         except Exception as e:
             logging.info(f"Failed to send supply priority command for {short_name} ({device_sn}): {e}")
 
-    def on_lower_limit_change(self, client, userdata, msg):
-        topic = msg.topic
-        payload = msg.payload.decode()
-        match = re.match(r"homeassistant/number/ecoflow_(.+)_battery_lower_limit/set", topic)
-        if not match:
-            return
-        short_name = match.group(1)
-
-        # Resolve short_name (e.g. ps1400) back to full device_sn
-        device_sn = None
-        for sn in self.heartbeats.keys():
-            if sn.lower().endswith(short_name[-4:]):
-                device_sn = sn
-                break
-
-        if not device_sn or not device_sn.startswith("HW51"):
-            return
-
+    def on_lower_limit_change(self, device_sn, short_name, payload):
         try:
             value = int(float(payload))
-            pack = BatLowerPack(lower_limit=value)
-            pdata_bytes = pack.SerializeToString()
-
-            msg_out = setMessage(
-                header=setHeader(
-                    pdata=pdata_bytes,
-                    src=32,
-                    dest=53,
-                    d_src=1,
-                    d_dest=1,
-                    check_type=3,
-                    cmd_func=20,
-                    cmd_id=132,  # WN511_SET_BAT_LOWER_PACK
-                    data_len=len(pdata_bytes),
-                    need_ack=1,
-                    seq=int(time.time()),
-                    version=19,
-                    payload_ver=1,
-                    **{"from": "ios"},
-                    device_sn=device_sn
-                )
-            )
-            topic = f"/sys/75/{device_sn}/thing/property/cmd"
-            self.client.publish(topic, msg_out.SerializeToString())
-            if self.control_logging:
-                logging.info(f"Sent Battery Lower Limit {value}% to {short_name} ({device_sn})")
+            if self._reported(device_sn, "lower_limit", value):
+                return
+            self._send_command(device_sn, 132, BatLowerPack(lower_limit=value).SerializeToString(), ("lower_limit", value))  # WN511_SET_BAT_LOWER_PACK
+            self.tracer.trace("controls", device_sn, "Sent Battery Lower Limit %s%% to %s (%s)", value, short_name, device_sn)
         except Exception as e:
             logging.info(f"Failed to send Battery Lower Limit for {short_name} ({device_sn}): {e}")
 
-    def on_upper_limit_change(self, client, userdata, msg):
-        topic = msg.topic
-        payload = msg.payload.decode()
-        match = re.match(r"homeassistant/number/ecoflow_(.+)_battery_upper_limit/set", topic)
-        if not match:
-            return
-        short_name = match.group(1)
-
-        # Resolve short_name (e.g., ps1400) back to full device_sn
-        device_sn = None
-        for sn in self.heartbeats.keys():
-            if sn.lower().endswith(short_name[-4:]):
-                device_sn = sn
-                break
-
-        if not device_sn or not device_sn.startswith("HW51"):
-            return
-
+    def on_upper_limit_change(self, device_sn, short_name, payload):
         try:
             value = int(float(payload))
-            pack = BatUpperPack(upper_limit=value)
-            pdata_bytes = pack.SerializeToString()
-
-            msg_out = setMessage(
-                header=setHeader(
-                    pdata=pdata_bytes,
-                    src=32,
-                    dest=53,
-                    d_src=1,
-                    d_dest=1,
-                    check_type=3,
-                    cmd_func=20,
-                    cmd_id=133,  # WN511_SET_BAT_UPPER_PACK
-                    data_len=len(pdata_bytes),
-                    need_ack=1,
-                    seq=int(time.time()),
-                    version=19,
-                    payload_ver=1,
-                    **{"from": "ios"},
-                    device_sn=device_sn
-                )
-            )
-            topic = f"/sys/75/{device_sn}/thing/property/cmd"
-            self.client.publish(topic, msg_out.SerializeToString())
-            if self.control_logging:
-                logging.info(f"Sent Battery Upper Limit {value}% to {short_name} ({device_sn})")
+            if self._reported(device_sn, "upper_limit", value):
+                return
+            self._send_command(device_sn, 133, BatUpperPack(upper_limit=value).SerializeToString(), ("upper_limit", value))  # WN511_SET_BAT_UPPER_PACK
+            self.tracer.trace("controls", device_sn, "Sent Battery Upper Limit %s%% to %s (%s)", value, short_name, device_sn)
         except Exception as e:
             logging.info(f"Failed to send Battery Upper Limit for {short_name} ({device_sn}): {e}")
 
-    def on_brightness_change(self, client, userdata, msg):
-        topic = msg.topic
-        payload = msg.payload.decode()
-        match = re.match(r"homeassistant/number/ecoflow_(.+)_inverter_brightness/set", topic)
-        if not match:
-            return
-        short_name = match.group(1)
-
-        # Resolve short_name (e.g., ps1400) back to full device_sn
-        device_sn = None
-        for sn in self.heartbeats.keys():
-            if sn.lower().endswith(short_name[-4:]):
-                device_sn = sn
-                break
-
-        if not device_sn or not device_sn.startswith("HW51"):
-            return
-
+    def on_brightness_change(self, device_sn, short_name, payload):
         try:
             percent = int(float(payload))
             # Scale 0–100% to 0–1023 (inverter bits)
             scaled_value = int((percent / 100.0) * 1023)
+            # Compared raw: a percentage does not survive the round trip (50% -> 511 -> 49%)
+            if self._reported(device_sn, "inv_brightness", scaled_value):
+                return
 
-            pack = BrightnessPack(brightness=scaled_value)
-            pdata_bytes = pack.SerializeToString()
-
-            msg_out = setMessage(
-                header=setHeader(
-                    pdata=pdata_bytes,
-                    src=32,
-                    dest=53,
-                    d_src=1,
-                    d_dest=1,
-                    check_type=3,
-                    cmd_func=20,
-                    cmd_id=135,  # WN511_SET_BRIGHTNESS_PACK
-                    data_len=len(pdata_bytes),
-                    need_ack=1,
-                    seq=int(time.time()),
-                    version=19,
-                    payload_ver=1,
-                    **{"from": "ios"},
-                    device_sn=device_sn
-                )
-            )
-            topic = f"/sys/75/{device_sn}/thing/property/cmd"
-            self.client.publish(topic, msg_out.SerializeToString())
-            if self.control_logging:
-                logging.info(f"Sent Brightness {percent}% ({scaled_value} bits) to {short_name} ({device_sn})")
+            self._send_command(device_sn, 135, BrightnessPack(brightness=scaled_value).SerializeToString(), ("inv_brightness", scaled_value))  # WN511_SET_BRIGHTNESS_PACK
+            self.tracer.trace("controls", device_sn, "Sent Brightness %s%% (%s bits) to %s (%s)", percent, scaled_value, short_name, device_sn)
         except Exception as e:
             logging.info(f"Failed to send Brightness for {short_name} ({device_sn}): {e}")
 
+class AsyncRuntime:
+    # runtime: asyncio. Drives paho from the event loop through its socket callbacks, consumes the
+    # decode queue in a task (optionally parsing in an executor) and runs timers via LoopScheduler
+
+    def __init__(self, decoder):
+        self.decoder, self.client = decoder, decoder.client
+        self.executor = ThreadPoolExecutor(max_workers=decoder.pipeline_workers) if decoder.decode_in_executor else None
+        self._misc = None
+
+    async def run(self):
+        loop = self.loop = asyncio.get_running_loop()
+        decoder, client = self.decoder, self.client
+        decoder.scheduler.loop = loop
+        self._frames, self._disconnected, stop = asyncio.Event(), asyncio.Event(), asyncio.Event()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, stop.set)
+
+        client.on_socket_open, client.on_socket_close = self._on_socket_open, self._on_socket_close
+        client.on_socket_register_write = lambda client, userdata, sock: loop.add_writer(sock, client.loop_write)
+        client.on_socket_unregister_write = lambda client, userdata, sock: loop.remove_writer(sock)
+        client.on_message = self._on_message
+        client.on_disconnect = lambda *args: (decoder.on_disconnect(*args), self._disconnected.set())
+
+        decoder.restore_devices()
+        logging.info(f"Connecting to MQTT broker {decoder.mqtt_host}:{decoder.mqtt_port} (asyncio runtime)...")
+        client.connect(decoder.mqtt_host, decoder.mqtt_port, 60)
+        decoder._start_metrics_server()
+        decoder.scheduler.schedule("discovery", decoder.discovery_interval, decoder.discovery_tick)
+        decoder.scheduler.schedule("save_devices", decoder.device_save_interval, decoder.save_devices_tick)
+        if decoder.energy_interval > 0:
+            decoder.scheduler.schedule("energy", decoder.energy_interval, decoder.energy_tick)
+        if decoder.site is not None:
+            decoder.scheduler.schedule("site", decoder.site_interval, decoder.site_tick)
+        if decoder.cluster is not None:
+            decoder.scheduler.schedule("cluster", decoder.cluster.interval, decoder.cluster_tick)
+        tasks = [loop.create_task(self._consume()), loop.create_task(self._reconnect())]
+        await stop.wait()
+
+        logging.info("Shutting down...")
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if decoder.cluster is not None:
+            # The loop's writer callback will not run again, so flush the announcement here
+            decoder.leave_cluster()
+            client.loop_write()
+        client.disconnect()
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+        if decoder.capture is not None:
+            decoder.capture.close()
+        decoder.save_devices()
+
+    def _on_message(self, client, userdata, msg):
+        self.decoder.on_message(client, userdata, msg)
+        self._frames.set()
+
+    def _on_socket_open(self, client, userdata, sock):
+        self.loop.add_reader(sock, client.loop_read)
+        self._misc = self.loop.create_task(self._misc_loop())
+
+    def _on_socket_close(self, client, userdata, sock):
+        self.loop.remove_reader(sock)
+        if self._misc is not None:
+            self._misc.cancel()
+
+    async def _misc_loop(self):
+        # Keepalive pings and retry bookkeeping that paho's own loop would otherwise do
+        while self.client.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+            await asyncio.sleep(1)
+
+    async def _reconnect(self):
+        while True:
+            await self._disconnected.wait()
+            delay = 1
+            while True:
+                await asyncio.sleep(delay)
+                try:
+                    self.client.reconnect()
+                    break
+                except OSError as e:
+                    logging.info(f"Reconnect failed: {e}")
+                    delay = min(delay * 2, 30)
+            self._disconnected.clear()
+
+    async def _consume(self):
+        # With an executor, up to pipeline_workers frames are parsed at once. Results are handled in
+        # queue order, and awaitables of coroutine handlers are awaited before the next frame
+        decoder, queue = self.decoder, self.decoder._decode_queue
+        batch_size = decoder.pipeline_workers if self.executor is not None else 1
+        while True:
+            await self._frames.wait()
+            self._frames.clear()
+            while len(queue):
+                batch = [queue.get()[1] for _ in range(min(batch_size, len(queue)))]
+                started = time.monotonic()
+                if self.executor is not None:
+                    parses = [self.loop.run_in_executor(self.executor, decoder.parse_frame, payload)
+                              for _, _, payload in batch]
+                for index, (seq, received, payload) in enumerate(batch):
+                    try:
+                        if self.executor is not None:
+                            frames, inline = await parses[index]
+                        else:
+                            frames, inline = decoder.parse_frame(payload)
+                    except DecodeError as e:
+                        decoder._count_decode_error(e)
+                        logging.info(f"Decode error: {e}")
+                        continue
+                    except Exception as e:
+                        decoder._count_decode_error(e)
+                        logging.exception("Unexpected error while decoding frame")
+                        continue
+                    decoder._record_latency("decode", time.monotonic() - started)
+                    for pending in decoder.handle_inline(inline):
+                        await _await_logged(pending, "inline frame handler")
+                    for device_sn, name, decoded in frames:
+                        pending = decoder.publish_step((device_sn, name), (seq, received, decoded))
+                        if pending is not None:
+                            await _await_logged(pending, "frame publisher")
+
+
 if __name__ == "__main__":
     decoder = EcoflowDecoder()
-    decoder.start()
+    if decoder.runtime == "asyncio":
+        asyncio.run(AsyncRuntime(decoder).run())
+    else:
+        decoder.start()